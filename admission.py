@@ -0,0 +1,228 @@
+"""Admission control for chat requests
+
+- ``TokenBucketLimiter`` rate-limits per key (client IP, session) and sweeps
+  idle buckets so the table does not grow without bound.
+- ``ConcurrencyGate`` caps in-flight upstream model calls per worker, with a
+  bounded wait queue and a deadline on the wait. ``AsyncConcurrencyGate`` is
+  the same for the asyncio server.
+
+Both raise or report a Retry-After hint so callers can answer 429/503 fast.
+"""
+import asyncio
+import math
+import os
+import threading
+import time
+
+IP_RATE = float(os.environ.get('RATE_LIMIT_IP_RATE', '1'))
+IP_BURST = float(os.environ.get('RATE_LIMIT_IP_BURST', '5'))
+SESSION_RATE = float(os.environ.get('RATE_LIMIT_SESSION_RATE', '0.5'))
+SESSION_BURST = float(os.environ.get('RATE_LIMIT_SESSION_BURST', '3'))
+
+# A threaded worker needs at least MAX_IN_FLIGHT + MAX_QUEUE threads, or the
+# queue never fills (gunicorn.conf.py sizes its threads from these)
+MAX_IN_FLIGHT = int(os.environ.get('ADMISSION_MAX_IN_FLIGHT', '16'))
+MAX_QUEUE = int(os.environ.get('ADMISSION_MAX_QUEUE', '32'))
+# Longest a request may wait for an upstream slot
+QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', '10'))
+# The async server holds far more streams per process than a threaded worker
+ASYNC_MAX_IN_FLIGHT = int(os.environ.get('ADMISSION_ASYNC_MAX_IN_FLIGHT', '256'))
+ASYNC_MAX_QUEUE = int(os.environ.get('ADMISSION_ASYNC_MAX_QUEUE', '512'))
+
+SWEEP_INTERVAL = 60
+
+
+class Overloaded(Exception):
+    """Raised when a request cannot get an upstream slot"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucketLimiter:
+    """Token bucket per key: rate tokens/second, holding at most burst"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        # key -> [tokens, last_update]
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+        self.rejected = 0
+
+    def allow(self, key):
+        """Take a token for key; return (allowed, seconds until one is available)"""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_sweep > SWEEP_INTERVAL:
+                self._sweep(now)
+
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.burst, now]
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return True, 0
+            self.rejected += 1
+            return False, (1 - bucket[0]) / self.rate
+
+    def _sweep(self, now):
+        # A bucket idle long enough to refill is indistinguishable from a new one
+        idle = self.burst / self.rate
+        for key in [k for k, (_, last) in self._buckets.items() if now - last > idle]:
+            del self._buckets[key]
+        self._last_sweep = now
+
+    def stats(self):
+        return {
+            'rate': self.rate,
+            'burst': self.burst,
+            'tracked_keys': len(self._buckets),
+            'rejected': self.rejected,
+        }
+
+
+class ConcurrencyGate:
+    """Caps concurrent upstream calls with a bounded, deadline-limited queue"""
+
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT, max_queue=MAX_QUEUE, queue_timeout=QUEUE_TIMEOUT):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self._cond = threading.Condition()
+        # Moving average of how long a slot is held, for Retry-After estimates
+        self._avg_hold = 1.0
+        self.admitted = 0
+        self.shed_queue_full = 0
+        self.shed_timeout = 0
+
+    def acquire(self, timeout=None):
+        """Wait for a slot; return a Slot or raise Overloaded"""
+        timeout = self.queue_timeout if timeout is None else timeout
+        with self._cond:
+            if self.in_flight >= self.max_in_flight:
+                if self.waiting >= self.max_queue:
+                    self.shed_queue_full += 1
+                    raise Overloaded('queue full', self._retry_after())
+
+                deadline = time.monotonic() + timeout
+                self.waiting += 1
+                try:
+                    while self.in_flight >= self.max_in_flight:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.shed_timeout += 1
+                            raise Overloaded('queue timeout', self._retry_after())
+                        self._cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+
+            self.in_flight += 1
+            self.admitted += 1
+        return Slot(self)
+
+    def _release(self, held):
+        with self._cond:
+            self.in_flight -= 1
+            self._avg_hold = 0.9 * self._avg_hold + 0.1 * held
+            self._cond.notify()
+
+    def _retry_after(self):
+        # Time for the queue ahead to drain at the current service rate
+        backlog = self.waiting + 1
+        return max(1, math.ceil(self._avg_hold * backlog / self.max_in_flight))
+
+    def stats(self):
+        return {
+            'max_in_flight': self.max_in_flight,
+            'max_queue': self.max_queue,
+            'queue_timeout': self.queue_timeout,
+            'in_flight': self.in_flight,
+            'queue_depth': self.waiting,
+            'admitted': self.admitted,
+            'shed_queue_full': self.shed_queue_full,
+            'shed_timeout': self.shed_timeout,
+            'avg_hold_seconds': round(self._avg_hold, 3),
+        }
+
+
+class AsyncConcurrencyGate(ConcurrencyGate):
+    """ConcurrencyGate for the asyncio server; acquire() is a coroutine"""
+
+    def __init__(self, max_in_flight=ASYNC_MAX_IN_FLIGHT, max_queue=ASYNC_MAX_QUEUE, queue_timeout=QUEUE_TIMEOUT):
+        super().__init__(max_in_flight, max_queue, queue_timeout)
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+
+    async def acquire(self, timeout=None):
+        timeout = self.queue_timeout if timeout is None else timeout
+        if self._semaphore.locked():
+            if self.waiting >= self.max_queue:
+                self.shed_queue_full += 1
+                raise Overloaded('queue full', self._retry_after())
+
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), timeout)
+            except asyncio.TimeoutError:
+                self.shed_timeout += 1
+                raise Overloaded('queue timeout', self._retry_after())
+            finally:
+                self.waiting -= 1
+        else:
+            await self._semaphore.acquire()
+
+        self.in_flight += 1
+        self.admitted += 1
+        return Slot(self)
+
+    def _release(self, held):
+        # Everything runs on the event loop thread, so no lock is needed
+        self.in_flight -= 1
+        self._avg_hold = 0.9 * self._avg_hold + 0.1 * held
+        self._semaphore.release()
+
+
+class Slot:
+    """A held upstream slot; release() is idempotent"""
+
+    __slots__ = ('_gate', '_acquired', '_released')
+
+    def __init__(self, gate):
+        self._gate = gate
+        self._acquired = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._gate._release(time.monotonic() - self._acquired)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+ip_limiter = TokenBucketLimiter(IP_RATE, IP_BURST)
+session_limiter = TokenBucketLimiter(SESSION_RATE, SESSION_BURST)
+upstream_gate = ConcurrencyGate()
+async_upstream_gate = AsyncConcurrencyGate()
+
+
+def stats():
+    return {
+        'ip_rate_limit': ip_limiter.stats(),
+        'session_rate_limit': session_limiter.stats(),
+        'upstream': upstream_gate.stats(),
+        'async_upstream': async_upstream_gate.stats(),
+    }
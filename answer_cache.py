@@ -0,0 +1,196 @@
+"""Answer caches that sit in front of the model call
+
+Tier 1 matches the question against faq.txt and returns the canned answer.
+Tier 2 is an LRU cache with a TTL over generated answers, keyed on the
+normalized message plus a digest of the recent history.
+"""
+import difflib
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import retrieval
+
+FAQ_MATCH_ENABLED = os.environ.get('FAQ_MATCH_ENABLED', '1') != '0'
+FAQ_MATCH_THRESHOLD = float(os.environ.get('FAQ_MATCH_THRESHOLD', '0.9'))
+FAQ_RESTYLE = os.environ.get('FAQ_RESTYLE', '0') == '1'
+
+ANSWER_CACHE_SIZE = int(os.environ.get('ANSWER_CACHE_SIZE', '1024'))
+ANSWER_CACHE_TTL = float(os.environ.get('ANSWER_CACHE_TTL', '3600'))
+# Prior turns folded into the cache key
+ANSWER_CACHE_HISTORY_TURNS = int(os.environ.get('ANSWER_CACHE_HISTORY_TURNS', '4'))
+
+_PUNCTUATION_RE = re.compile(r"[^\w\s]")
+_SPACE_RE = re.compile(r"\s+")
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+(?=[A-Z])")
+
+
+def normalize(text):
+    """Lowercase, strip punctuation and collapse whitespace"""
+    text = _PUNCTUATION_RE.sub(' ', text.lower())
+    return _SPACE_RE.sub(' ', text).strip()
+
+
+def history_digest(history, turns=ANSWER_CACHE_HISTORY_TURNS):
+    """Digest of the last few turns, so follow-ups are cached per context"""
+    digest = hashlib.sha1()
+    for msg in history[-turns:] if turns else []:
+        digest.update(msg.role.encode())
+        digest.update(b'\0')
+        digest.update(msg.content.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def restyle(answer):
+    """Lay a canned FAQ answer out one sentence per line"""
+    sentences = _SENTENCE_RE.split(answer.strip())
+    return "📌 " + "\n\n".join(sentences)
+
+
+class FaqMatcher:
+    """Finds the faq.txt entry a question is a near-verbatim copy of
+
+    A fuzzy match must also use exactly the same content terms, so a one-word
+    change ("rented" for "leased", "delete" for "add") is not a match.
+    Questions listed more than once with different answers are never
+    answered from the FAQ; the model sees both through retrieval instead.
+    """
+
+    def __init__(self, pairs, threshold=FAQ_MATCH_THRESHOLD):
+        self.threshold = threshold
+        self.answers = {}
+        self.conflicting = set()
+        for pair in pairs:
+            key = normalize(pair['question'])
+            if key in self.answers and self.answers[key] != pair['answer']:
+                self.conflicting.add(key)
+            self.answers.setdefault(key, pair['answer'])
+        for key in self.conflicting:
+            del self.answers[key]
+        self.hits = 0
+        self.misses = 0
+
+    def match(self, message):
+        """Return the canned answer for message, or None"""
+        key = normalize(message)
+        answer = self.answers.get(key)
+
+        if answer is None and key and key not in self.conflicting:
+            terms = set(retrieval.tokenize(message))
+            # Only the few FAQ entries the index ranks highest are compared
+            for _, chunk in retrieval.get_index().search(message, top_k=5):
+                if chunk['source'] != 'faq':
+                    continue
+                candidate = normalize(chunk['title'])
+                if (set(retrieval.tokenize(candidate)) == terms
+                        and difflib.SequenceMatcher(None, key, candidate).ratio() >= self.threshold):
+                    answer = self.answers.get(candidate)
+                    break
+
+        if answer is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return restyle(answer) if FAQ_RESTYLE else answer
+
+
+class ResponseCache:
+    """Thread-safe LRU cache whose entries expire after ttl seconds"""
+
+    def __init__(self, max_size=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_faq_matcher = None
+_faq_lock = threading.Lock()
+response_cache = ResponseCache()
+
+
+def get_faq_matcher():
+    global _faq_matcher
+    if _faq_matcher is None:
+        with _faq_lock:
+            if _faq_matcher is None:
+                _faq_matcher = FaqMatcher(retrieval.parse_faq())
+    return _faq_matcher
+
+
+def cache_key(message, history):
+    """Key for a message asked after history (the turns before it)"""
+    return f"{history_digest(history)}:{normalize(message)}"
+
+
+def lookup(message, key):
+    """Return (tier, answer) from the first tier that has one, else (None, None)"""
+    if FAQ_MATCH_ENABLED:
+        answer = get_faq_matcher().match(message)
+        if answer is not None:
+            return 'faq', answer
+
+    answer = response_cache.get(key)
+    if answer is not None:
+        return 'response', answer
+    return None, None
+
+
+def store(key, answer):
+    """Remember a generated answer under its cache key"""
+    if answer:
+        response_cache.set(key, answer)
+
+
+def stats():
+    """Hit/miss counts per tier"""
+    faq = _faq_matcher
+    return {
+        'faq': {
+            'enabled': FAQ_MATCH_ENABLED,
+            'conflicting_questions': len(faq.conflicting) if faq else 0,
+            'hits': faq.hits if faq else 0,
+            'misses': faq.misses if faq else 0,
+        },
+        'response': {
+            'hits': response_cache.hits,
+            'misses': response_cache.misses,
+            'evictions': response_cache.evictions,
+            'size': len(response_cache),
+            'max_size': response_cache.max_size,
+            'ttl': response_cache.ttl,
+        },
+    }
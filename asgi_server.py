@@ -0,0 +1,418 @@
+"""Async (ASGI) server for the Infoins V4 chatbot
+
+Serves the same /, /api/chat, /api/chat/stream, /api/clear and /api/health
+contract as chatbot_server.py, but every upstream call goes through the
+SDK's async client, so one process holds hundreds of concurrent chats.
+
+Run with:  python asgi_server.py
+      or:  uvicorn asgi_server:app --host 0.0.0.0 --port 5000 --workers 2
+
+With more than one worker, /metrics sums over all of them only when
+PROMETHEUS_MULTIPROC_DIR points at an empty directory; python asgi_server.py
+sets that up itself.
+"""
+import asyncio
+import math
+import os
+import shutil
+import tempfile
+import time
+from functools import wraps
+
+from quart import Quart, request, jsonify, send_from_directory, Response, g
+from quart_cors import cors
+
+import admission
+import answer_cache
+import coalescing
+import conversation_store
+import gemini_client
+import metrics
+import resilience
+import retrieval
+from chatbot_server import (
+    context_caches,
+    conversations,
+    history_manager,
+    ground_request,
+    router,
+    sse_event,
+    stream_reply_async,
+)
+
+app = cors(Quart(__name__, static_folder='.'))
+
+
+@app.before_serving
+async def warm_up():
+    """Load the index and open upstream connections before taking traffic"""
+    await asyncio.to_thread(retrieval.get_index)
+    await gemini_client.warm_up_async()
+
+
+def rate_limit(f):
+    @wraps(f)
+    async def decorated_function(*args, **kwargs):
+        timer = g.timer = metrics.RequestTimer(request.endpoint)
+        with timer.stage('rate_limit'):
+            data = await request.get_json(silent=True) or {}
+            checks = (
+                (admission.ip_limiter, request.remote_addr),
+                (admission.session_limiter, data.get('session_id', 'default')),
+            )
+
+            for limiter, key in checks:
+                allowed, retry_after = limiter.allow(key)
+                if not allowed:
+                    break
+
+        if not allowed:
+            timer.finish('rate_limited')
+            response = jsonify({'error': 'Too many requests. Please wait.'})
+            response.headers['Retry-After'] = str(math.ceil(retry_after))
+            return response, 429
+
+        return await f(*args, **kwargs)
+    return decorated_function
+
+
+# SqliteStore calls can wait out its busy timeout on another worker's write
+# lock, which must not stall every other stream; MemoryStore ones are quick
+_STORE_BLOCKS = not isinstance(conversations, conversation_store.MemoryStore)
+
+
+async def store_call(fn, *args):
+    """Call a conversation store method, off the event loop if it can block"""
+    if _STORE_BLOCKS:
+        return await asyncio.to_thread(fn, *args)
+    return fn(*args)
+
+
+def overloaded_response(e):
+    response = jsonify({'error': 'The assistant is busy right now. Please try again shortly.'})
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, 503
+
+
+def error_response(e):
+    status, outcome, message, retry_after = resilience.describe_error(e)
+    response = jsonify({'error': message})
+    if retry_after:
+        response.headers['Retry-After'] = str(retry_after)
+    return response, status, outcome
+
+
+class ReplyBody:
+    """Response body for a streamed reply; aclose() releases what it holds
+
+    Quart ends a body with aclose(), which skips the finally of an async
+    generator that never started, so a client gone before the first event
+    would keep its admission slot for good. The reply, the slot and the
+    timer are released here instead, whether or not the events started.
+    """
+
+    def __init__(self, events, reply, slot, timer, on_close):
+        self._events = events
+        self._reply = reply
+        self._slot = slot
+        self._timer = timer
+        self._on_close = on_close
+        self._closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self._events.__anext__()
+
+    async def aclose(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            await self._events.aclose()
+            # Closes the upstream call (or leaves a shared one) on a disconnect
+            await self._reply.aclose()
+        finally:
+            if self._slot:
+                self._slot.release()
+            await self._on_close()
+
+    def __del__(self):
+        # Dropped before Quart took the body: nothing was sent, so just release
+        if not self._closed:
+            self._closed = True
+            if self._slot:
+                self._slot.release()
+            self._timer.finish('disconnected')
+
+
+async def start_reply(session_id, history, user_message, timer):
+    """Async counterpart of chatbot_server.start_reply"""
+    key = coalescing.coalesce_key(user_message, history)
+    flight = None
+    if key:
+        flight, leader = coalescing.async_single_flight.join(key)
+        if not leader:
+            async def record_user_turn():
+                history.append(await store_call(conversations.append, session_id, 'user', user_message))
+            return flight.subscribe(record_user_turn), None
+
+    slot = None
+    try:
+        resilience.upstream.check(probe=False)
+        with timer.stage('queue'):
+            slot = await admission.async_upstream_gate.acquire()
+        history.append(await store_call(conversations.append, session_id, 'user', user_message))
+        # History folding and BM25 search are CPU work; keep them off the loop too
+        with timer.stage('build_contents'):
+            contents = await asyncio.to_thread(history_manager.contents, session_id, history)
+        with timer.stage('setup'):
+            gemini_client.get_client()
+            contents, route = await asyncio.to_thread(ground_request, contents, user_message, history[:-1])
+        timer.model, timer.tier = route.tier.model, route.tier.name
+    except BaseException as e:
+        if slot:
+            slot.release()
+        if flight:
+            # A cancelled leader must still release the requests waiting on it
+            error = e if isinstance(e, Exception) else RuntimeError('Reply was cancelled')
+            coalescing.async_single_flight.fail(key, flight, error)
+        raise
+
+    config, model = route.tier.config, route.tier.model
+    if flight is None:
+        return stream_reply_async(contents, config, model), slot
+
+    coalescing.async_single_flight.start(key, flight, lambda: stream_reply_async(contents, config, model), slot)
+    return flight.subscribe(), None
+
+
+@app.route('/')
+async def index():
+    return await send_from_directory('.', 'chatbot_interface.html')
+
+
+@app.route('/api/chat', methods=['POST'])
+@rate_limit
+async def chat():
+    timer = g.timer
+    try:
+        data = await request.get_json()
+        user_message = data.get('message', '')
+        session_id = data.get('session_id', 'default')
+
+        if not user_message:
+            timer.finish('invalid')
+            return jsonify({'error': 'No message provided'}), 400
+
+        history = await store_call(conversations.history, session_id)
+
+        cache_key = answer_cache.cache_key(user_message, history)
+        cache_tier, cached_answer = answer_cache.lookup(user_message, cache_key)
+
+        if cached_answer is not None:
+            await store_call(conversations.append, session_id, 'user', user_message)
+            await store_call(conversations.append, session_id, 'assistant', cached_answer)
+            with timer.stage('serialize'):
+                response = jsonify({
+                    'response': cached_answer,
+                    'session_id': session_id,
+                    'cached': cache_tier
+                })
+            timer.finish('cached', user_message, cached_answer)
+            return response
+
+        # A client disconnect cancels this task; the slot is released on the way out
+        reply, slot = await start_reply(session_id, history, user_message, timer)
+        chunks = []
+        started = time.perf_counter()
+        try:
+            async for text in reply:
+                if not chunks:
+                    timer.add('first_chunk', time.perf_counter() - started)
+                chunks.append(text)
+        finally:
+            # Leaves a shared generation, which stops once nobody reads it
+            await reply.aclose()
+            if slot:
+                slot.release()
+        timer.add('stream', time.perf_counter() - started)
+        response_text = ''.join(chunks)
+
+        await store_call(conversations.append, session_id, 'assistant', response_text)
+        answer_cache.store(cache_key, response_text)
+
+        with timer.stage('serialize'):
+            response = jsonify({
+                'response': response_text,
+                'session_id': session_id,
+                'tier': timer.tier
+            })
+        timer.finish('ok', user_message, response_text)
+        return response
+
+    except admission.Overloaded as e:
+        timer.finish('overloaded')
+        return overloaded_response(e)
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        response, status, outcome = error_response(e)
+        timer.finish(outcome)
+        return response, status
+
+
+@app.route('/api/chat/stream', methods=['POST'])
+@rate_limit
+async def chat_stream():
+    """Stream the reply as Server-Sent Events, one event per model chunk"""
+    timer = g.timer
+    data = await request.get_json(silent=True) or {}
+    user_message = data.get('message', '')
+    session_id = data.get('session_id', 'default')
+
+    if not user_message:
+        timer.finish('invalid')
+        return jsonify({'error': 'No message provided'}), 400
+
+    history = await store_call(conversations.history, session_id)
+
+    cache_key = answer_cache.cache_key(user_message, history)
+    cache_tier, cached_answer = answer_cache.lookup(user_message, cache_key)
+
+    if cached_answer is not None:
+        await store_call(conversations.append, session_id, 'user', user_message)
+        await store_call(conversations.append, session_id, 'assistant', cached_answer)
+        body = sse_event({'text': cached_answer}) + sse_event({
+            'session_id': session_id,
+            'response_length': len(cached_answer),
+            'chunks': 1,
+            'cached': cache_tier,
+        }, event='done')
+        timer.finish('cached', user_message, cached_answer)
+        return Response(body, mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+    try:
+        reply, slot = await start_reply(session_id, history, user_message, timer)
+    except admission.Overloaded as e:
+        timer.finish('overloaded')
+        return overloaded_response(e)
+
+    chunks = []
+    completed = False
+    outcome = 'disconnected'
+
+    async def generate():
+        nonlocal completed, outcome
+        started = time.time()
+        first_chunk_at = None
+        try:
+            yield ": stream open\n\n"
+
+            upstream_started = time.perf_counter()
+            async for text in reply:
+                if first_chunk_at is None:
+                    first_chunk_at = time.time()
+                    timer.add('first_chunk', time.perf_counter() - upstream_started)
+                chunks.append(text)
+                with timer.stage('serialize'):
+                    event = sse_event({'text': text})
+                yield event
+            completed = True
+            outcome = 'ok'
+            timer.add('stream', time.perf_counter() - upstream_started)
+
+            yield sse_event({
+                'session_id': session_id,
+                'response_length': sum(len(c) for c in chunks),
+                'chunks': len(chunks),
+                'time_to_first_chunk': round(first_chunk_at - started, 3) if first_chunk_at else None,
+                'elapsed': round(time.time() - started, 3),
+                'tier': timer.tier,
+            }, event='done')
+        except Exception as e:
+            print(f"Error: {str(e)}")
+            _, outcome, message, _ = resilience.describe_error(e)
+            yield sse_event({'error': message}, event='error')
+
+    async def finish():
+        # Also runs after a disconnect, keeping the partial reply
+        if chunks:
+            await store_call(conversations.append, session_id, 'assistant', ''.join(chunks))
+        if completed:
+            answer_cache.store(cache_key, ''.join(chunks))
+        timer.finish(outcome, user_message, ''.join(chunks))
+
+    response = Response(
+        ReplyBody(generate(), reply, slot, timer, finish),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+        },
+    )
+    # Long answers outlive Quart's default response timeout
+    response.timeout = None
+    return response
+
+
+@app.route('/api/health')
+async def health():
+    return jsonify({
+        'status': 'ok',
+        'client': gemini_client.client_status(),
+        'cache': answer_cache.stats(),
+        'conversations': await store_call(conversations.stats),
+        'admission': admission.stats(),
+        'coalescing': coalescing.async_single_flight.stats(),
+        'context_cache': context_caches.stats(),
+        'routing': router.stats(),
+        'upstream': resilience.upstream.stats(),
+    })
+
+
+@app.route('/metrics')
+async def metrics_page():
+    # Rendering reads the session gauges from the conversation store
+    body, content_type = await store_call(metrics.render)
+    return Response(body, content_type=content_type)
+
+
+@app.route('/api/clear', methods=['POST'])
+async def clear_conversation():
+    try:
+        data = await request.get_json()
+        session_id = data.get('session_id', 'default')
+
+        await store_call(conversations.clear, session_id)
+        history_manager.forget(session_id)
+
+        return jsonify({'message': 'Conversation cleared'})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    if not os.environ.get("GEMINI_API_KEY"):
+        print("WARNING: GEMINI_API_KEY environment variable not set!")
+
+    port = int(os.environ.get('PORT', '5000'))
+    workers = int(os.environ.get('WEB_CONCURRENCY', '1'))
+    metrics_dir = None
+    if workers > 1 and not os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        # Workers are fresh interpreters that read this on import, so /metrics sums them
+        metrics_dir = os.environ['PROMETHEUS_MULTIPROC_DIR'] = tempfile.mkdtemp(prefix='infoins-metrics-')
+    print(f"\n🚀 Starting Infoins V4 Chatbot Server (async) on port {port}...")
+    try:
+        uvicorn.run(
+            'asgi_server:app',
+            host='0.0.0.0',
+            port=port,
+            workers=workers,
+            timeout_keep_alive=5,
+        )
+    finally:
+        if metrics_dir:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
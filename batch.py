@@ -0,0 +1,254 @@
+"""Answer a JSONL file of questions offline, with the same prompts as the chat servers
+
+Usage: python batch.py INPUT.jsonl OUTPUT.jsonl [--concurrency N] [--rate R]
+                       [--retries N] [--tier lite|standard|full] [--restart]
+
+Each input line is an object with the question in 'message' (falling back
+to 'body' or 'title'), an optional 'id' (or 'request_id') and an optional
+'history' list of {"role": "user"|"assistant", "content": ...} turns.
+Prompts are built exactly as for /api/chat: build_conversation_contents,
+knowledge-base grounding, routing and the system instruction.
+
+Each output line is written as soon as its answer is complete, so results
+come out of input order; 'line' is the input line number. Questions that
+still fail after the retries get an 'error' instead of an 'answer'.
+
+Progress is checkpointed next to the output (OUTPUT.jsonl.checkpoint).
+Running the same command again resumes where it stopped: the output is cut
+back to the last checkpoint and only unanswered lines are sent. The
+checkpoint records an input offset and the few lines finished beyond it,
+so memory stays flat however long the input is.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+# One line per routed question would drown the progress output
+os.environ.setdefault('ROUTING_LOG', '0')
+
+import admission
+import resilience
+from chatbot_server import (
+    build_conversation_contents,
+    ground_request,
+    router,
+    stream_reply_async,
+)
+from conversation_store import Turn
+
+# Lines finished beyond the checkpoint offset are kept in memory; the reader
+# waits once it gets this far ahead of the oldest unfinished line
+MAX_WINDOW = 1000
+CHECKPOINT_INTERVAL = 1.0
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 30.0
+
+
+def is_retryable(e):
+    """Transient upstream failures, and the circuit breaker shedding calls"""
+    return resilience.is_transient(e) or isinstance(e, admission.Overloaded)
+
+
+class Checkpoint:
+    """Low watermark over the input: every line before offset is answered
+
+    done holds line numbers past the watermark that are also answered, and
+    pending maps dispatched line numbers to the input offset after them.
+    """
+
+    def __init__(self, path, offset=0, line=0, done=(), output_bytes=0):
+        self.path = path
+        self.offset = offset
+        self.line = line
+        self.done = set(done)
+        self.output_bytes = output_bytes
+        self.pending = {}
+        self.advanced = asyncio.Event()
+        self._saved_at = 0.0
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as f:
+            state = json.load(f)
+        return cls(path, state['offset'], state['line'], state['done'], state['output_bytes'])
+
+    def dispatch(self, line, end_offset):
+        self.pending[line] = end_offset
+
+    def complete(self, line):
+        self.done.add(line)
+        while self.line in self.done:
+            self.done.discard(self.line)
+            self.offset = self.pending.pop(self.line, self.offset)
+            self.line += 1
+        self.advanced.set()
+        self.advanced = asyncio.Event()
+
+    def save(self, output_bytes, force=False):
+        now = time.monotonic()
+        if not force and now - self._saved_at < CHECKPOINT_INTERVAL:
+            return
+        self._saved_at = now
+        self.output_bytes = output_bytes
+        temp = self.path + '.tmp'
+        with open(temp, 'w', encoding='utf-8') as f:
+            json.dump({
+                'offset': self.offset,
+                'line': self.line,
+                'done': sorted(self.done),
+                'output_bytes': output_bytes,
+            }, f)
+        os.replace(temp, self.path)
+
+
+def parse_line(raw):
+    entry = json.loads(raw)
+    message = entry.get('message') or entry.get('body') or entry.get('title')
+    if not message:
+        raise ValueError('no message, body or title')
+    history = [Turn(turn['role'], turn['content']) for turn in entry.get('history') or []]
+    return entry.get('id') or entry.get('request_id'), message, history
+
+
+async def answer(message, history, tier_name, timeout):
+    """Generate one answer; returns (text, tier name)"""
+    turns = history + [Turn('user', message)]
+    contents = build_conversation_contents(turns)
+    contents, route = ground_request(contents, message, history)
+    tier = router.tiers[tier_name] if tier_name else route.tier
+
+    async def generate():
+        return ''.join([text async for text in stream_reply_async(contents, tier.config, tier.model)])
+
+    return await asyncio.wait_for(generate(), timeout), tier.name
+
+
+async def process(raw, args, limiter):
+    """Answer one input line, retrying with jittered exponential backoff"""
+    started = time.monotonic()
+    try:
+        item_id, message, history = parse_line(raw)
+    except (ValueError, KeyError, TypeError) as e:
+        return {'error': f'invalid input: {e}'}
+
+    result = {'id': item_id, 'message': message}
+    for attempt in range(1, args.retries + 2):
+        if limiter:
+            allowed, wait = limiter.allow('batch')
+            while not allowed:
+                await asyncio.sleep(wait)
+                allowed, wait = limiter.allow('batch')
+        try:
+            text, tier = await answer(message, history, args.tier, args.timeout)
+            result.update(answer=text, tier=tier)
+            break
+        except Exception as e:
+            if attempt > args.retries or not is_retryable(e):
+                result['error'] = f'{type(e).__name__}: {e}'
+                break
+            delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1)))
+            await asyncio.sleep(delay)
+    result.update(attempts=attempt, elapsed=round(time.monotonic() - started, 3))
+    return result
+
+
+async def run(args):
+    checkpoint_path = args.output + '.checkpoint'
+    if args.restart or not os.path.exists(checkpoint_path):
+        if os.path.exists(args.output) and not args.restart:
+            sys.exit(f"{args.output} exists without a checkpoint; pass --restart to overwrite it")
+        checkpoint = Checkpoint(checkpoint_path)
+    else:
+        checkpoint = Checkpoint.load(checkpoint_path)
+        print(f"Resuming at line {checkpoint.line} "
+              f"({len(checkpoint.done)} later line(s) already answered)")
+
+    # Anything written after the last checkpoint is answered again
+    output = open(args.output, 'ab')
+    output.truncate(checkpoint.output_bytes)
+    output.seek(checkpoint.output_bytes)
+    checkpoint.save(checkpoint.output_bytes, force=True)
+
+    limiter = admission.TokenBucketLimiter(args.rate, max(1.0, args.rate)) if args.rate else None
+    queue = asyncio.Queue(maxsize=args.concurrency * 2)
+    counts = {'answered': 0, 'failed': 0}
+    started = time.monotonic()
+
+    async def read():
+        with open(args.input, 'rb') as f:
+            f.seek(checkpoint.offset)
+            line = checkpoint.line
+            for raw in iter(f.readline, b''):
+                end = f.tell()
+                if line in checkpoint.done or not raw.strip():
+                    checkpoint.dispatch(line, end)
+                    if not raw.strip():
+                        checkpoint.complete(line)
+                else:
+                    while line - checkpoint.line >= MAX_WINDOW:
+                        await checkpoint.advanced.wait()
+                    checkpoint.dispatch(line, end)
+                    await queue.put((line, raw))
+                line += 1
+        for _ in range(args.concurrency):
+            await queue.put(None)
+
+    async def work():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            line, raw = item
+            result = await process(raw, args, limiter)
+            result = {'line': line, **result}
+            output.write(json.dumps(result, ensure_ascii=False).encode('utf-8') + b'\n')
+            output.flush()
+            counts['failed' if 'error' in result else 'answered'] += 1
+            checkpoint.complete(line)
+            checkpoint.save(output.tell())
+
+            total = counts['answered'] + counts['failed']
+            if total % args.progress == 0:
+                rate = total / (time.monotonic() - started)
+                print(f"  {total} done ({counts['failed']} failed), {rate:.1f}/s")
+
+    try:
+        await asyncio.gather(read(), *(work() for _ in range(args.concurrency)))
+    finally:
+        checkpoint.save(output.tell(), force=True)
+        output.close()
+
+    elapsed = time.monotonic() - started
+    print(f"✅ {counts['answered']} answered, {counts['failed']} failed in {elapsed:.1f}s -> {args.output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog='\n'.join(__doc__.splitlines()[2:]),
+    )
+    parser.add_argument('input')
+    parser.add_argument('output')
+    parser.add_argument('--concurrency', type=int, default=8, help='questions in flight at once')
+    parser.add_argument('--rate', type=float, default=0, help='max questions started per second (0: no limit)')
+    parser.add_argument('--retries', type=int, default=4, help='retries per question for transient errors')
+    parser.add_argument('--timeout', type=float, default=120, help='seconds allowed per attempt')
+    parser.add_argument('--tier', choices=sorted(router.tiers), help='send every question to this tier')
+    parser.add_argument('--progress', type=int, default=100, help='print progress every N answers')
+    parser.add_argument('--restart', action='store_true', help='ignore the checkpoint and start over')
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        print("Stopped; run the same command again to resume")
+        sys.exit(130)
+
+
+if __name__ == '__main__':
+    main()
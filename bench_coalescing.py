@@ -0,0 +1,86 @@
+"""Check that identical concurrent questions share one upstream call
+
+Usage: python bench_coalescing.py [--requests N] [--delay SECONDS]
+
+Swaps in the fake backend from fake_backend.py, fires N identical
+first-turn questions at both the threaded Flask app and the async app at
+once, and reports how many upstream calls were made. Exits non-zero unless
+each server made exactly one.
+"""
+import argparse
+import asyncio
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import admission
+import answer_cache
+import fake_backend
+import gemini_client
+
+QUESTION = "What should I do right after a hailstorm damages my roof?"
+
+
+def run_threaded(n):
+    import chatbot_server
+
+    def ask(i):
+        client = chatbot_server.app.test_client()
+        response = client.post('/api/chat', json={'message': QUESTION, 'session_id': f'flask-{i}'})
+        return response.status_code, response.json.get('response')
+
+    with ThreadPoolExecutor(max_workers=n) as pool:
+        return list(pool.map(ask, range(n)))
+
+
+def run_async(n):
+    import asgi_server
+
+    async def ask(client, i):
+        response = await client.post('/api/chat', json={'message': QUESTION, 'session_id': f'asgi-{i}'})
+        return response.status_code, (await response.get_json()).get('response')
+
+    async def main():
+        client = asgi_server.app.test_client()
+        return await asyncio.gather(*(ask(client, i) for i in range(n)))
+
+    return asyncio.run(main())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--delay', type=float, default=1.0, help='fake generation time in seconds')
+    args = parser.parse_args()
+
+    # Keep the limiters out of the way; this measures coalescing only
+    for limiter in (admission.ip_limiter, admission.session_limiter):
+        limiter.burst = args.requests * 2
+
+    # One client for both runs, so state it keeps (context caches) stays valid
+    fake = fake_backend.FakeClient(fake_backend.FakeSettings(
+        ttft=args.delay / 2, tokens_per_second=100, chunk_tokens=10, reply_tokens=50, error_rate=0,
+    ))
+    gemini_client.get_client = lambda: fake
+
+    ok = True
+    for name, run in (('flask', run_threaded), ('asgi', run_async)):
+        # Start each server cold so the response cache cannot answer for it
+        answer_cache.response_cache = answer_cache.ResponseCache()
+        calls_before = fake.call_count
+        started = time.perf_counter()
+        results = run(args.requests)
+        elapsed = time.perf_counter() - started
+        calls = fake.call_count - calls_before
+
+        statuses = {status for status, _ in results}
+        answers = {answer for _, answer in results}
+        print(f"{name}: {args.requests} requests -> {calls} upstream call(s), "
+              f"statuses {sorted(statuses)}, {len(answers)} distinct answer(s), {elapsed:.2f}s")
+        ok &= calls == 1 and statuses == {200} and len(answers) == 1
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
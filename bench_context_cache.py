@@ -0,0 +1,105 @@
+"""Check the context cache against the fake backend
+
+Usage: python bench_context_cache.py [--requests N]
+
+Sends N questions through chatbot_server.stream_reply and reports how many
+referenced the cached system instruction rather than sending it inline,
+then checks the fallbacks: a quota error is not taken for a broken cache,
+a cache deleted upstream is dropped and the request resent inline, and a
+prefix too small to cache stays inline. Exits non-zero if any check fails.
+"""
+import argparse
+import sys
+import time
+
+from google.genai import errors, types
+
+import context_cache
+import fake_backend
+import gemini_client
+
+
+def ask(chatbot_server, question, config=None):
+    contents = [types.Content(role='user', parts=[types.Part.from_text(text=question)])]
+    return ''.join(chatbot_server.stream_reply(contents, config))
+
+
+def wait_ready(manager, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        caches = manager.stats()['caches']
+        if caches and all(c['ready'] or c['error'] for c in caches):
+            return
+        time.sleep(0.01)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=20)
+    args = parser.parse_args()
+
+    fake = fake_backend.FakeClient(fake_backend.FakeSettings(
+        ttft=0.01, tokens_per_second=100000, error_rate=0, slow_rate=0,
+    ))
+    gemini_client.get_client = lambda: fake
+    import chatbot_server
+
+    checks = []
+
+    # The first request goes inline while the cache is created in the background
+    ask(chatbot_server, "How do I add a new user?")
+    wait_ready(chatbot_server.context_caches)
+    for i in range(args.requests - 1):
+        ask(chatbot_server, f"How do I add a new user? ({i})")
+    used = [call['cached_content'] for call in fake.calls]
+    cached = sum(1 for name in used if name)
+    print(f"{len(used)} requests: {cached} used the cache, {len(used) - cached} sent the prefix inline")
+    checks.append(cached == args.requests - 1)
+
+    print(f"cached prefix: {chatbot_server.context_caches.stats()['caches'][0]}")
+
+    # Quota exhausted: the error reaches the caller and the cache is kept
+    generate = fake.models.generate_content_stream
+
+    def over_quota(model, contents, config=None):
+        raise errors.ClientError(429, {'error': {
+            'code': 429, 'message': 'Resource has been exhausted', 'status': 'RESOURCE_EXHAUSTED',
+        }})
+    fake.models.generate_content_stream = over_quota
+    try:
+        ask(chatbot_server, "How do I add a new user?")
+        error = None
+    except errors.ClientError as e:
+        error = e
+    finally:
+        fake.models.generate_content_stream = generate
+    entry = chatbot_server.context_caches.stats()['caches'][0]
+    print(f"quota error: raised {getattr(error, 'code', None)}, entry ready {entry['ready']}, "
+          f"error {entry['error']}")
+    checks.append(getattr(error, 'code', None) == 429 and entry['ready'] and entry['error'] is None)
+
+    # A cache that disappeared upstream: the request is retried inline and the entry dropped
+    fake.caches.delete(used[-1])
+    before = fake.call_count
+    answer = ask(chatbot_server, "How do I reset a password?")
+    retried = [call['cached_content'] for call in list(fake.calls)[-(fake.call_count - before):]]
+    entry = chatbot_server.context_caches.stats()['caches'][0]
+    print(f"deleted cache: calls {retried}, answered {bool(answer)}, entry ready {entry['ready']}")
+    checks.append(retried == [used[-1], None] and bool(answer) and not entry['ready'])
+
+    # Too small for the API's minimum: stays inline, the error is kept for /api/health
+    manager = context_cache.ContextCacheManager(gemini_client.get_client)
+    small = types.GenerateContentConfig(system_instruction="Be brief.")
+    manager.resolve(small, gemini_client.MODEL)
+    wait_ready(manager)
+    inline = manager.resolve(small, gemini_client.MODEL) is small
+    print(f"small prefix: inline {inline}, error {manager.stats()['caches'][0]['error'] is not None}")
+    checks.append(inline)
+
+    ok = all(checks)
+    print("✅ context cache checks passed" if ok else "❌ context cache checks failed")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
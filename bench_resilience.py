@@ -0,0 +1,198 @@
+"""Check deadlines, retries, hedging and the circuit breaker against the fake backend
+
+Usage: python bench_resilience.py [--requests N]
+
+Runs resilience.Upstream over fake_backend.FakeClient with injected
+latency and errors:
+
+- a stalled first chunk and a reply that runs too long both end in
+  UpstreamTimeout at their deadlines (threaded and asyncio drivers)
+- with half the calls failing, retries answer nearly every request, and a
+  failure after the first chunk is not retried
+- with a slow tail (FAKE_SLOW_RATE), hedging cuts p99 time to first chunk
+- an upstream that always fails opens the breaker, which then sheds calls
+  without sending them, and closes again after a successful probe
+
+Exits non-zero if any check fails.
+"""
+import argparse
+import asyncio
+import sys
+import time
+
+from google.genai import errors, types
+
+import fake_backend
+import resilience
+
+
+def fake(**settings):
+    defaults = dict(ttft=0.05, tokens_per_second=4000, chunk_tokens=8, reply_tokens=40,
+                    error_rate=0, slow_rate=0, thinking_seconds=0, search_seconds=0)
+    defaults.update(settings)
+    return fake_backend.FakeClient(fake_backend.FakeSettings(**defaults))
+
+
+def upstream(**policy):
+    breaker = resilience.CircuitBreaker(
+        enabled=policy.pop('breaker', False), window=20, min_calls=10, threshold=0.5,
+        cooldown=policy.pop('cooldown', 0.5),
+    )
+    defaults = dict(timeout=10, first_chunk_timeout=5, retries=0, retry_base=0.01,
+                    retry_max=0.05, hedge=False, breaker=breaker)
+    defaults.update(policy)
+    return resilience.Upstream(**defaults)
+
+
+def contents(i):
+    return [types.Content(role='user', parts=[types.Part.from_text(text=f"Question {i}")])]
+
+
+def ask(up, client, i):
+    """Blocking call; returns (ok, time to first chunk, error)"""
+    started = time.monotonic()
+    first = None
+    try:
+        for _ in up.stream(lambda: client.models.generate_content_stream(
+                model='fake', contents=contents(i)), 'fake'):
+            first = first or time.monotonic() - started
+        return True, first, None
+    except Exception as e:
+        return False, first, e
+
+
+async def ask_async(up, client, i):
+    started = time.monotonic()
+    first = None
+    try:
+        async for _ in up.stream_async(lambda: client.aio.models.generate_content_stream(
+                model='fake', contents=contents(i)), 'fake'):
+            first = first or time.monotonic() - started
+        return True, first, None
+    except Exception as e:
+        return False, first, e
+
+
+async def ask_many(up, client, n, concurrency=50):
+    gate = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with gate:
+            return await ask_async(up, client, i)
+    return await asyncio.gather(*(one(i) for i in range(n)))
+
+
+def quantile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def check_deadlines():
+    ok = True
+    client = fake(ttft=2)
+    up = upstream(first_chunk_timeout=0.2)
+    started = time.monotonic()
+    _, _, error = ask(up, client, 0)
+    elapsed = time.monotonic() - started
+    print(f"stalled first chunk (threads): {type(error).__name__} after {elapsed:.2f}s")
+    ok &= isinstance(error, resilience.UpstreamTimeout) and error.stage == 'first_chunk' and elapsed < 0.5
+
+    started = time.monotonic()
+    _, _, error = asyncio.run(ask_async(up, client, 0))
+    elapsed = time.monotonic() - started
+    print(f"stalled first chunk (asyncio): {type(error).__name__} after {elapsed:.2f}s")
+    ok &= isinstance(error, resilience.UpstreamTimeout) and elapsed < 0.5
+
+    # 40 tokens at 20/s is two seconds of streaming
+    client = fake(tokens_per_second=20)
+    up = upstream(timeout=0.5)
+    started = time.monotonic()
+    _, first, error = ask(up, client, 0)
+    elapsed = time.monotonic() - started
+    print(f"slow stream: first chunk after {first:.2f}s, {type(error).__name__} after {elapsed:.2f}s")
+    ok &= isinstance(error, resilience.UpstreamTimeout) and error.stage == 'total' and elapsed < 0.8
+    return ok
+
+
+def check_retries(n):
+    ok = True
+    for retries in (0, 3):
+        client = fake(error_rate=0.5)
+        results = asyncio.run(ask_many(upstream(retries=retries), client, n))
+        answered = sum(1 for r in results if r[0])
+        print(f"50% errors, {retries} retries: {answered}/{n} answered, {client.call_count} upstream calls")
+        ok &= answered >= (n * 0.9 if retries else 0)
+
+    # A failure after the first chunk reaches the caller as is
+    calls = []
+
+    def broken_stream():
+        calls.append(1)
+        yield 'partial'
+        raise errors.ServerError(503, {'error': {'code': 503, 'message': 'dropped', 'status': 'UNAVAILABLE'}})
+
+    up = upstream(retries=3)
+    received = []
+    try:
+        for chunk in up.stream(broken_stream, 'fake'):
+            received.append(chunk)
+        error = None
+    except errors.ServerError as e:
+        error = e
+    print(f"failure after the first chunk: {len(calls)} call(s), {received}, {type(error).__name__}")
+    ok &= len(calls) == 1 and received == ['partial'] and error is not None
+    return ok
+
+
+def check_hedging(n):
+    p99 = {}
+    for hedge in (False, True):
+        client = fake(slow_rate=0.03, slow_factor=30, seed=1)
+        up = upstream(hedge=hedge, hedge_min_delay=0.1)
+        # Learn the usual time to first chunk before measuring
+        asyncio.run(ask_many(up, client, 100))
+        before = client.call_count
+        results = asyncio.run(ask_many(up, client, n))
+        firsts = [first for ok, first, _ in results if ok]
+        p99[hedge] = quantile(firsts, 0.99)
+        stats = up.stats()
+        print(f"hedging {'on ' if hedge else 'off'}: p50 {quantile(firsts, 0.5):.3f}s "
+              f"p99 {p99[hedge]:.3f}s, {client.call_count - before} calls for {n} requests, "
+              f"events {stats['events']}, delay {stats['hedge_delay']}")
+    return p99[True] < p99[False] / 2
+
+
+def check_breaker():
+    client = fake(error_rate=1)
+    up = upstream(breaker=True, cooldown=0.5)
+    results = asyncio.run(ask_many(up, client, 30, concurrency=1))
+    shed = sum(1 for _, _, e in results if isinstance(e, resilience.CircuitOpen))
+    state = up.breaker.state
+    print(f"upstream down: {client.call_count} calls for 30 requests, {shed} shed, breaker {state}")
+    ok = state == 'open' and shed >= 15 and client.call_count <= 12
+
+    client.settings.error_rate = 0
+    time.sleep(0.6)
+    answered, _, error = ask(up, client, 100)
+    print(f"upstream back: probe answered {answered}, breaker {up.breaker.state}")
+    return ok and answered and up.breaker.state == 'closed'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=400)
+    args = parser.parse_args()
+
+    checks = [
+        check_deadlines(),
+        check_retries(args.requests),
+        check_hedging(args.requests),
+        check_breaker(),
+    ]
+    ok = all(checks)
+    print("✅ resilience checks passed" if ok else "❌ resilience checks failed")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Recall and latency benchmark for the retrieval index
+
+Usage: python bench_retrieval.py [--top-k K] [--repeat N]
+
+Every faq.txt question is used as a query and should retrieve its own FAQ
+entry. A second pass shuffles the question's keywords and drops a third of
+them to approximate a loosely worded user question.
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+
+import retrieval
+
+
+def keyword_variant(question, rng):
+    """Shuffle the question's keywords and drop about a third of them"""
+    words = retrieval.tokenize(question)
+    rng.shuffle(words)
+    keep = max(1, len(words) - len(words) // 3)
+    return ' '.join(words[:keep])
+
+
+def run(index, queries, top_k, repeat):
+    ranks = []
+    timings = []
+    for query, expected in queries:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            results = index.search(query, top_k=top_k)
+            timings.append(time.perf_counter() - started)
+        titles = [chunk['title'] for _, chunk in results]
+        ranks.append(titles.index(expected) + 1 if expected in titles else None)
+
+    found = [r for r in ranks if r]
+    timings_us = np.array(timings) * 1e6
+    return {
+        'recall@1': sum(1 for r in found if r == 1) / len(ranks),
+        f'recall@{top_k}': len(found) / len(ranks),
+        'mrr': sum(1 / r for r in found) / len(ranks),
+        'p50_us': float(np.percentile(timings_us, 50)),
+        'p95_us': float(np.percentile(timings_us, 95)),
+        'p99_us': float(np.percentile(timings_us, 99)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--top-k', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=20, help='timed searches per query')
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    index = retrieval.RetrievalIndex.build(retrieval.load_chunks(), retrieval.source_digest())
+    build_ms = (time.perf_counter() - started) * 1000
+
+    rng = random.Random(args.seed)
+    questions = [pair['question'] for pair in retrieval.parse_faq()]
+    suites = {
+        'exact': [(q, q) for q in questions],
+        'keywords': [(keyword_variant(q, rng), q) for q in questions],
+    }
+
+    print(f"Index: {len(index.chunks)} chunks, {len(index.vocab)} terms, built in {build_ms:.1f} ms")
+    for name, queries in suites.items():
+        stats = run(index, queries, args.top_k, args.repeat)
+        print(f"\n{name} ({len(queries)} queries)")
+        for key, value in stats.items():
+            print(f"  {key:>10}: {value:.3f}" if 'us' not in key else f"  {key:>10}: {value:.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,35 +1,79 @@
 import os
-from flask import Flask, request, jsonify, send_from_directory
+import json
+from flask import Flask, request, jsonify, send_from_directory, Response, stream_with_context, g
 from flask_cors import CORS
-from google import genai
-from google.genai import types
+from google.genai import errors, types
 import time
+import math
 from functools import wraps
+import admission
+import gemini_client
+import retrieval
+import answer_cache
+import coalescing
+import context_cache
+import conversation_store
+import metrics
+import prompt_history
+import resilience
+import routing
 
 app = Flask(__name__, static_folder='.')
 CORS(app)
 
-# Rate limiting (simple in-memory solution)
-last_request_time = {}
-REQUEST_COOLDOWN = 1  # seconds between requests per IP
-
+# Rate limiting (token buckets per IP and per session, see admission.py)
 def rate_limit(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        client_ip = request.remote_addr
-        current_time = time.time()
+        # Stage timings for this request, reported on /metrics
+        timer = g.timer = metrics.RequestTimer(request.endpoint)
+        with timer.stage('rate_limit'):
+            data = request.get_json(silent=True) or {}
+            checks = (
+                (admission.ip_limiter, request.remote_addr),
+                (admission.session_limiter, data.get('session_id', 'default')),
+            )
+            
+            for limiter, key in checks:
+                allowed, retry_after = limiter.allow(key)
+                if not allowed:
+                    break
         
-        if client_ip in last_request_time:
-            time_since_last = current_time - last_request_time[client_ip]
-            if time_since_last < REQUEST_COOLDOWN:
-                return jsonify({'error': 'Too many requests. Please wait.'}), 429
+        if not allowed:
+            timer.finish('rate_limited')
+            response = jsonify({'error': 'Too many requests. Please wait.'})
+            response.headers['Retry-After'] = str(math.ceil(retry_after))
+            return response, 429
         
-        last_request_time[client_ip] = current_time
         return f(*args, **kwargs)
     return decorated_function
 
-# Store conversation history per session
-conversations = {}
+def overloaded_response(e):
+    """503 telling the client when the upstream queue should have room"""
+    response = jsonify({'error': 'The assistant is busy right now. Please try again shortly.'})
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, 503
+
+def error_response(e):
+    """Status and message for a failed reply: 503/504 for upstream trouble, else 500"""
+    status, outcome, message, retry_after = resilience.describe_error(e)
+    response = jsonify({'error': message})
+    if retry_after:
+        response.headers['Retry-After'] = str(retry_after)
+    return response, status, outcome
+
+# Local knowledge-base grounding
+RETRIEVAL_ENABLED = os.environ.get('RETRIEVAL_ENABLED', '1') != '0'
+RETRIEVAL_TOP_K = int(os.environ.get('RETRIEVAL_TOP_K', '4'))
+RETRIEVAL_MIN_SCORE = float(os.environ.get('RETRIEVAL_MIN_SCORE', '5.5'))
+GROUNDING_PREAMBLE = (
+    "Reference material from the Infoins knowledge base. Answer from it where it "
+    "applies and do not contradict it.\n\n"
+)
+
+# Store conversation history per session (see conversation_store.py)
+conversations = conversation_store.create_store()
+metrics.watch_store(conversations)
 
 @app.route('/')
 def index():
@@ -38,69 +82,194 @@ def index():
 @app.route('/api/chat', methods=['POST'])
 @rate_limit
 def chat():
+    timer = g.timer
     try:
         data = request.json
         user_message = data.get('message', '')
         session_id = data.get('session_id', 'default')
         
         if not user_message:
+            timer.finish('invalid')
             return jsonify({'error': 'No message provided'}), 400
         
-        # Initialize Google AI client
-        client = genai.Client(
-            api_key=os.environ.get("GEMINI_API_KEY"),
-        )
-        
-        # Get or create conversation history
-        if session_id not in conversations:
-            conversations[session_id] = []
+        # Get conversation history
+        history = conversations.history(session_id)
         
-        # Add user message to history
-        conversations[session_id].append({
-            'role': 'user',
-            'content': user_message
-        })
+        # Answer from the FAQ or the response cache when possible
+        cache_key = answer_cache.cache_key(user_message, history)
+        cache_tier, cached_answer = answer_cache.lookup(user_message, cache_key)
         
-        # Build contents for API call
-        contents = build_conversation_contents(conversations[session_id])
+        if cached_answer is not None:
+            conversations.append(session_id, 'user', user_message)
+            conversations.append(session_id, 'assistant', cached_answer)
+            with timer.stage('serialize'):
+                response = jsonify({
+                    'response': cached_answer,
+                    'session_id': session_id,
+                    'cached': cache_tier
+                })
+            timer.finish('cached', user_message, cached_answer)
+            return response
         
-        # Configure the generation
-        generate_content_config = types.GenerateContentConfig(
-            thinking_config=types.ThinkingConfig(
-                thinking_budget=-1,
-            ),
-            tools=[types.Tool(googleSearch=types.GoogleSearch())],
-            system_instruction=[
-                types.Part.from_text(text=get_system_instruction()),
-            ],
-        )
+        # Start (or join) the upstream reply; shed requests leave the history untouched
+        chunks, slot = start_reply(session_id, history, user_message, timer)
         
         # Generate response
         response_text = ""
-        model = "gemini-flash-latest"
-        
-        for chunk in client.models.generate_content_stream(
-            model=model,
-            contents=contents,
-            config=generate_content_config,
-        ):
-            if chunk.text:
-                response_text += chunk.text
+        started = time.perf_counter()
+        try:
+            for text in chunks:
+                if not response_text:
+                    timer.add('first_chunk', time.perf_counter() - started)
+                response_text += text
+        finally:
+            # Leaves a shared generation, which stops once nobody reads it
+            chunks.close()
+            if slot:
+                slot.release()
+        timer.add('stream', time.perf_counter() - started)
         
         # Add assistant response to history
-        conversations[session_id].append({
-            'role': 'assistant',
-            'content': response_text
-        })
+        conversations.append(session_id, 'assistant', response_text)
+        answer_cache.store(cache_key, response_text)
         
-        return jsonify({
-            'response': response_text,
-            'session_id': session_id
-        })
+        with timer.stage('serialize'):
+            response = jsonify({
+                'response': response_text,
+                'session_id': session_id,
+                'tier': timer.tier
+            })
+        timer.finish('ok', user_message, response_text)
+        return response
         
+    except admission.Overloaded as e:
+        timer.finish('overloaded')
+        return overloaded_response(e)
     except Exception as e:
         print(f"Error: {str(e)}")
-        return jsonify({'error': f'An error occurred: {str(e)}'}), 500
+        response, status, outcome = error_response(e)
+        timer.finish(outcome)
+        return response, status
+
+@app.route('/api/chat/stream', methods=['POST'])
+@rate_limit
+def chat_stream():
+    """Stream the reply as Server-Sent Events, one event per model chunk"""
+    timer = g.timer
+    data = request.json or {}
+    user_message = data.get('message', '')
+    session_id = data.get('session_id', 'default')
+    
+    if not user_message:
+        timer.finish('invalid')
+        return jsonify({'error': 'No message provided'}), 400
+    
+    history = conversations.history(session_id)
+    
+    cache_key = answer_cache.cache_key(user_message, history)
+    cache_tier, cached_answer = answer_cache.lookup(user_message, cache_key)
+    
+    if cached_answer is not None:
+        conversations.append(session_id, 'user', user_message)
+        conversations.append(session_id, 'assistant', cached_answer)
+        body = sse_event({'text': cached_answer}) + sse_event({
+            'session_id': session_id,
+            'response_length': len(cached_answer),
+            'chunks': 1,
+            'cached': cache_tier,
+        }, event='done')
+        timer.finish('cached', user_message, cached_answer)
+        return Response(body, mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+    
+    try:
+        reply, slot = start_reply(session_id, history, user_message, timer)
+    except admission.Overloaded as e:
+        timer.finish('overloaded')
+        return overloaded_response(e)
+    
+    def generate():
+        started = time.time()
+        first_chunk_at = None
+        chunks = []
+        completed = False
+        outcome = 'disconnected'
+        try:
+            # Open the stream straight away so proxies and the browser start reading
+            yield ": stream open\n\n"
+            
+            upstream_started = time.perf_counter()
+            for text in reply:
+                if first_chunk_at is None:
+                    first_chunk_at = time.time()
+                    timer.add('first_chunk', time.perf_counter() - upstream_started)
+                chunks.append(text)
+                with timer.stage('serialize'):
+                    event = sse_event({'text': text})
+                yield event
+            completed = True
+            outcome = 'ok'
+            timer.add('stream', time.perf_counter() - upstream_started)
+            
+            yield sse_event({
+                'session_id': session_id,
+                'response_length': sum(len(c) for c in chunks),
+                'chunks': len(chunks),
+                'time_to_first_chunk': round(first_chunk_at - started, 3) if first_chunk_at else None,
+                'elapsed': round(time.time() - started, 3),
+                'tier': timer.tier,
+            }, event='done')
+        except Exception as e:
+            print(f"Error: {str(e)}")
+            _, outcome, message, _ = resilience.describe_error(e)
+            yield sse_event({'error': message}, event='error')
+        finally:
+            reply.close()
+            if slot:
+                slot.release()
+            # Runs on completion and when the client disconnects (generator closed),
+            # so the history keeps whatever the model produced
+            if chunks:
+                conversations.append(session_id, 'assistant', ''.join(chunks))
+            # Only complete replies are worth serving again
+            if completed:
+                answer_cache.store(cache_key, ''.join(chunks))
+            timer.finish(outcome, user_message, ''.join(chunks))
+    
+    response = Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+        },
+    )
+    # Also covers a client that leaves before the generator starts
+    response.call_on_close(reply.close)
+    if slot:
+        response.call_on_close(slot.release)
+    response.call_on_close(lambda: timer.finish('disconnected', user_message))
+    return response
+
+@app.route('/api/health')
+def health():
+    """Report whether this worker has its upstream client ready"""
+    return jsonify({
+        'status': 'ok',
+        'client': gemini_client.client_status(),
+        'cache': answer_cache.stats(),
+        'conversations': conversations.stats(),
+        'admission': admission.stats(),
+        'coalescing': coalescing.single_flight.stats(),
+        'context_cache': context_caches.stats(),
+        'routing': router.stats(),
+        'upstream': resilience.upstream.stats(),
+    })
+
+@app.route('/metrics')
+def metrics_page():
+    """Prometheus metrics, summed over every worker"""
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
 
 @app.route('/api/clear', methods=['POST'])
 def clear_conversation():
@@ -108,20 +277,181 @@ def clear_conversation():
         data = request.json
         session_id = data.get('session_id', 'default')
         
-        if session_id in conversations:
-            conversations[session_id] = []
+        conversations.clear(session_id)
+        history_manager.forget(session_id)
         
         return jsonify({'message': 'Conversation cleared'})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def sse_event(payload, event=None):
+    """Format a payload as a single Server-Sent Events message"""
+    message = f"data: {json.dumps(payload)}\n\n"
+    if event:
+        message = f"event: {event}\n" + message
+    return message
+
+def start_reply(session_id, history, user_message, timer):
+    """Record the user turn and start, or join, the upstream reply
+    
+    Returns an iterator over the reply text and the admission slot the caller
+    must release (None when the slot is owned by a shared generation). Raises
+    admission.Overloaded without touching the history when no slot is free.
+    Stage timings are added to timer (a metrics.RequestTimer).
+    """
+    key = coalescing.coalesce_key(user_message, history)
+    flight = None
+    if key:
+        flight, leader = coalescing.single_flight.join(key)
+        if not leader:
+            # Recorded only once the shared reply arrives, so a follower of a
+            # shed leader leaves the history untouched too
+            return flight.subscribe(
+                lambda: history.append(conversations.append(session_id, 'user', user_message))
+            ), None
+    
+    slot = None
+    try:
+        # Shed at once while the circuit breaker is open
+        resilience.upstream.check(probe=False)
+        with timer.stage('queue'):
+            slot = admission.upstream_gate.acquire()
+        history.append(conversations.append(session_id, 'user', user_message))
+        with timer.stage('build_contents'):
+            contents = history_manager.contents(session_id, history)
+        with timer.stage('setup'):
+            # Builds the client on a cold worker, so that is not counted as first_chunk
+            gemini_client.get_client()
+            contents, route = ground_request(contents, user_message, history[:-1])
+        timer.model, timer.tier = route.tier.model, route.tier.name
+    except Exception as e:
+        if slot:
+            slot.release()
+        if flight:
+            coalescing.single_flight.fail(key, flight, e)
+        raise
+    
+    config, model = route.tier.config, route.tier.model
+    if flight is None:
+        return stream_reply(contents, config, model), slot
+    
+    # Identical first-turn questions share this generation
+    coalescing.single_flight.start(key, flight, lambda: stream_reply(contents, config, model), slot)
+    return flight.subscribe(), None
+
+def stream_reply(contents, config=None, model=None):
+    """Yield the model reply text chunk by chunk as it arrives
+    
+    The system instruction comes from the context cache when one is ready. If
+    the API rejects the cache before any text arrived, the request is sent
+    again with the instruction inline. Deadlines, retries, hedging and the
+    circuit breaker are applied by resilience.upstream.
+    """
+    client = gemini_client.get_client()
+    config = config or GENERATE_CONTENT_CONFIG
+    model = model or gemini_client.MODEL
+    request_config = context_caches.resolve(config, model)
+    label = upstream_label(config, model)
+    
+    usage = None
+    started = False
+    try:
+        while True:
+            try:
+                for chunk in resilience.upstream.stream(
+                    lambda: client.models.generate_content_stream(
+                        model=model,
+                        contents=contents,
+                        config=request_config,
+                    ),
+                    label,
+                ):
+                    if chunk.usage_metadata:
+                        usage = chunk.usage_metadata
+                    if chunk.text:
+                        started = True
+                        yield chunk.text
+                return
+            except errors.ClientError as e:
+                if started or request_config is config or not context_cache.rejects_cache(e):
+                    raise
+                context_caches.invalidate(config, model, e)
+                request_config = config
+    finally:
+        metrics.record_usage(model, usage)
+
+async def stream_reply_async(contents, config=None, model=None):
+    """Async counterpart of stream_reply, used by the ASGI server"""
+    client = gemini_client.get_client()
+    config = config or GENERATE_CONTENT_CONFIG
+    model = model or gemini_client.MODEL
+    request_config = context_caches.resolve(config, model)
+    label = upstream_label(config, model)
+    
+    usage = None
+    started = False
+    try:
+        while True:
+            stream = resilience.upstream.stream_async(
+                lambda: client.aio.models.generate_content_stream(
+                    model=model,
+                    contents=contents,
+                    config=request_config,
+                ),
+                label,
+            )
+            try:
+                async for chunk in stream:
+                    if chunk.usage_metadata:
+                        usage = chunk.usage_metadata
+                    if chunk.text:
+                        started = True
+                        yield chunk.text
+                return
+            except errors.ClientError as e:
+                if started or request_config is config or not context_cache.rejects_cache(e):
+                    raise
+                context_caches.invalidate(config, model, e)
+                request_config = config
+            finally:
+                # Closes the upstream stream when the caller is cancelled mid-reply
+                await stream.aclose()
+    finally:
+        metrics.record_usage(model, usage)
+
+def upstream_label(config, model):
+    """Name for a model setup whose times to first chunk are alike (for hedging)"""
+    return model + ('+search' if config.tools else '')
+
+def ground_request(contents, user_message, history=()):
+    """Attach matching knowledge-base chunks to the latest user turn
+    
+    Returns the contents and the routing.Route (model tier and config) to send
+    them with. history is the conversation before this message.
+    """
+    results = []
+    if RETRIEVAL_ENABLED:
+        results = retrieval.get_index().search(user_message, top_k=RETRIEVAL_TOP_K)
+    score = results[0][0] if results else 0.0
+    if score < RETRIEVAL_MIN_SCORE:
+        return contents, router.route(user_message, history, score, grounded=False)
+    
+    grounded_turn = types.Content(
+        role="user",
+        parts=[
+            types.Part.from_text(text=GROUNDING_PREAMBLE + retrieval.format_context(results)),
+            types.Part.from_text(text=user_message),
+        ],
+    )
+    return contents[:-1] + [grounded_turn], router.route(user_message, history, score, grounded=True)
+
 def build_conversation_contents(history):
     """Convert conversation history to API format"""
     contents = []
     
     for msg in history:
-        role = msg['role']
-        content = msg['content']
+        role = msg.role
+        content = msg.content
         
         if role == 'user':
             contents.append(
@@ -382,6 +712,31 @@ Updated Tone Summary
 
 The chatbot remains professional and instructional, with light emoji usage to improve clarity and user comfort — without reducing seriousness or security awareness."""
 
+# Built once per process and shared by every request
+SYSTEM_INSTRUCTION_PART = types.Part.from_text(text=get_system_instruction())
+
+def build_tier_config(tier):
+    """The GenerateContentConfig for a routing tier"""
+    return types.GenerateContentConfig(
+        thinking_config=types.ThinkingConfig(
+            thinking_budget=tier.thinking_budget,
+        ),
+        tools=[types.Tool(googleSearch=types.GoogleSearch())] if tier.search else None,
+        system_instruction=[SYSTEM_INSTRUCTION_PART],
+    )
+
+# Picks the model, thinking budget and tools per request (see routing.py)
+router = routing.Router(build_tier_config)
+
+# Unbounded thinking plus web search, for requests that skip routing
+GENERATE_CONTENT_CONFIG = router.tiers['full'].config
+
+# Per-session prompt windows, extended incrementally and kept within budget
+history_manager = prompt_history.HistoryManager(build_conversation_contents)
+
+# The system instruction is registered upstream once instead of sent per request
+context_caches = context_cache.ContextCacheManager(gemini_client.get_client)
+
 if __name__ == '__main__':
     # Check if API key is set
     if not os.environ.get("GEMINI_API_KEY"):
@@ -395,4 +750,5 @@ if __name__ == '__main__':
     print("🌐 Access from other devices: http://YOUR_IP_ADDRESS:5000")
     print("\nPress Ctrl+C to stop the server\n")
     
+    # Development server; production runs asgi_server.py (or gunicorn -c gunicorn.conf.py)
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,336 @@
+"""Single-flight coalescing of identical concurrent questions
+
+The first request for a key starts the upstream generation (the leader);
+identical requests arriving while it is in flight subscribe to it and replay
+its chunks instead of starting their own call. The generation runs apart from
+any one subscriber, so the leader disconnecting does not cut off the others;
+once every subscriber has gone, it is stopped and its admission slot freed.
+
+Only first-turn questions are coalesced: later turns carry session history in
+the prompt, so two of them are never the same request.
+"""
+import asyncio
+import os
+import threading
+
+from answer_cache import normalize
+
+COALESCE_ENABLED = os.environ.get('COALESCE_ENABLED', '1') != '0'
+
+
+class Subscription:
+    """Iterator over a flight's chunks; close() unsubscribes
+
+    A class rather than a generator so that closing it before the first
+    chunk still counts as leaving.
+    """
+
+    def __init__(self, flight, chunks, on_first=None):
+        self._flight = flight
+        self._chunks = chunks
+        self._on_first = on_first
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        text = next(self._chunks)
+        if self._on_first is not None:
+            on_first, self._on_first = self._on_first, None
+            on_first()
+        return text
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._chunks.close()
+            self._flight.leave()
+
+    __del__ = close
+
+
+class Flight:
+    """One in-flight generation that any number of threads can read
+
+    subscribers counts the requests joined to it; when the last one leaves
+    before the flight is done, on_abandon is called.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.abandoned = False
+        self.on_abandon = None
+        self._cond = threading.Condition()
+
+    def enter(self):
+        with self._cond:
+            self.subscribers += 1
+
+    def leave(self):
+        with self._cond:
+            self.subscribers -= 1
+            abandon = self.subscribers <= 0 and not self.done and not self.abandoned
+            if abandon:
+                self.abandoned = True
+        if abandon and self.on_abandon is not None:
+            self.on_abandon()
+
+    def publish(self, text):
+        with self._cond:
+            self.chunks.append(text)
+            self._cond.notify_all()
+
+    def finish(self, error=None):
+        with self._cond:
+            self.done = True
+            self.error = error
+            self._cond.notify_all()
+
+    def subscribe(self, on_first=None):
+        """Iterator over every chunk from the start, then the rest as they arrive
+
+        The caller must have joined the flight; closing the iterator leaves it.
+        on_first is called just before the first chunk is handed over.
+        """
+        return Subscription(self, self._replay(), on_first)
+
+    def _replay(self):
+        index = 0
+        while True:
+            with self._cond:
+                while index >= len(self.chunks) and not self.done:
+                    self._cond.wait()
+                pending = self.chunks[index:]
+                finished = self.done
+            for text in pending:
+                yield text
+            index += len(pending)
+            if finished and index >= len(self.chunks):
+                if self.error is not None:
+                    raise self.error
+                return
+
+
+class AsyncSubscription:
+    """Subscription for the asyncio server; aclose() unsubscribes"""
+
+    def __init__(self, flight, chunks, on_first=None):
+        self._flight = flight
+        self._chunks = chunks
+        self._on_first = on_first
+        self._closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        text = await self._chunks.__anext__()
+        if self._on_first is not None:
+            on_first, self._on_first = self._on_first, None
+            await on_first()
+        return text
+
+    async def aclose(self):
+        if not self._closed:
+            self._closed = True
+            await self._chunks.aclose()
+            self._flight.leave()
+
+    def __del__(self):
+        # Without a loop to close the replay on, just leave
+        if not self._closed:
+            self._closed = True
+            self._flight.leave()
+
+
+class AsyncFlight:
+    """Flight for the asyncio server"""
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.abandoned = False
+        self.on_abandon = None
+        # The producer task, cancelled when every subscriber has gone
+        self.task = None
+        self._changed = asyncio.Event()
+
+    def enter(self):
+        self.subscribers += 1
+
+    def leave(self):
+        self.subscribers -= 1
+        if self.subscribers <= 0 and not self.done and not self.abandoned:
+            self.abandoned = True
+            if self.on_abandon is not None:
+                self.on_abandon()
+
+    def publish(self, text):
+        self.chunks.append(text)
+        self._wake()
+
+    def finish(self, error=None):
+        self.done = True
+        self.error = error
+        self._wake()
+
+    def _wake(self):
+        # Waiters hold the old event; later ones wait on the fresh one
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def subscribe(self, on_first=None):
+        """on_first is a coroutine function here"""
+        return AsyncSubscription(self, self._replay(), on_first)
+
+    async def _replay(self):
+        index = 0
+        while True:
+            changed = self._changed
+            while index < len(self.chunks):
+                yield self.chunks[index]
+                index += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await changed.wait()
+
+
+class SingleFlight:
+    """Registry of in-flight generations keyed by normalized question"""
+
+    flight_class = Flight
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+        self.abandoned = 0
+
+    def join(self, key):
+        """Return (flight, is_leader); the leader must call start() or fail()
+
+        Either way the caller is a subscriber and must then subscribe() and
+        close the subscription, or the generation is never stopped early.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None and not flight.abandoned:
+                self.coalesced += 1
+                flight.enter()
+                return flight, False
+            flight = self._flights[key] = self.flight_class()
+            flight.on_abandon = lambda: self._abandon(key, flight)
+            flight.enter()
+            self.leaders += 1
+            return flight, True
+
+    def start(self, key, flight, produce, slot=None):
+        """Run produce() (an iterator of chunks) for the flight in the background
+
+        slot, when given, is released once the upstream call finishes.
+        """
+        thread = threading.Thread(
+            target=self._run, args=(key, flight, produce, slot), daemon=True
+        )
+        thread.start()
+
+    def fail(self, key, flight, error):
+        """Abandon a flight before it started, passing error to its subscribers"""
+        self._finish(key, flight, error)
+
+    def _run(self, key, flight, produce, slot):
+        error = None
+        chunks = produce()
+        try:
+            for text in chunks:
+                # Nobody is listening any more: stop the upstream call
+                if flight.abandoned:
+                    break
+                flight.publish(text)
+        except Exception as e:
+            error = e
+        finally:
+            chunks.close()
+            if slot is not None:
+                slot.release()
+            self._finish(key, flight, error)
+
+    def _abandon(self, key, flight):
+        """Every subscriber left: new identical questions start a fresh flight"""
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            self.abandoned += 1
+
+    def _finish(self, key, flight, error):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.finish(error)
+
+    def stats(self):
+        return {
+            'enabled': COALESCE_ENABLED,
+            'in_flight': len(self._flights),
+            'leaders': self.leaders,
+            'coalesced': self.coalesced,
+            'abandoned': self.abandoned,
+        }
+
+
+class AsyncSingleFlight(SingleFlight):
+    """SingleFlight for the asyncio server; produce() is an async iterator"""
+
+    flight_class = AsyncFlight
+
+    def __init__(self):
+        super().__init__()
+        # Strong references so running producers are not garbage collected
+        self._tasks = set()
+
+    def start(self, key, flight, produce, slot=None):
+        task = asyncio.create_task(self._run_async(key, flight, produce, slot))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        if slot is not None:
+            # A task cancelled before its first step never runs _run_async's finally
+            task.add_done_callback(lambda _: slot.release())
+        flight.task = task
+
+    def _abandon(self, key, flight):
+        super()._abandon(key, flight)
+        # Cancelling closes the upstream stream and releases the slot
+        if flight.task is not None:
+            flight.task.cancel()
+
+    async def _run_async(self, key, flight, produce, slot):
+        error = None
+        try:
+            async for text in produce():
+                flight.publish(text)
+        except Exception as e:
+            error = e
+        finally:
+            if slot is not None:
+                slot.release()
+            self._finish(key, flight, error)
+
+
+def coalesce_key(message, history):
+    """Key under which this request may share a generation, or None"""
+    if not COALESCE_ENABLED or history:
+        return None
+    return normalize(message)
+
+
+single_flight = SingleFlight()
+async_single_flight = AsyncSingleFlight()
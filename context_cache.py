@@ -0,0 +1,206 @@
+"""Explicit context caching of the static prompt prefix
+
+The system instruction (and, for ungrounded requests, the web search tool)
+is identical on every request. ``ContextCacheManager`` registers it once per
+model as cached content and hands out a copy of the config that references
+the cache instead of resending the prefix.
+
+- The cache display name carries a hash of the model, instruction and tools,
+  so workers and restarts reuse a live cache and a changed instruction gets
+  a new one.
+- The cache TTL is extended in the background before it runs out.
+- Until a cache is ready, and for CONTEXT_CACHE_RETRY seconds after any
+  failure (model without caching support, prefix below the minimum size,
+  quota), requests use the inline config unchanged.
+- A reply the API refuses because of the cache it references (see
+  ``rejects_cache``) is resent inline; quota and other request errors are not.
+"""
+import hashlib
+import os
+import threading
+import time
+
+from google.genai import types
+
+CONTEXT_CACHE_ENABLED = os.environ.get('CONTEXT_CACHE_ENABLED', '1') != '0'
+CONTEXT_CACHE_TTL = int(os.environ.get('CONTEXT_CACHE_TTL', '3600'))
+# Extend the TTL once less than this many seconds are left
+CONTEXT_CACHE_REFRESH_MARGIN = float(os.environ.get('CONTEXT_CACHE_REFRESH_MARGIN', '600'))
+CONTEXT_CACHE_RETRY = float(os.environ.get('CONTEXT_CACHE_RETRY', '300'))
+
+DISPLAY_PREFIX = 'infoins-'
+# Stop using a cache this close to its expiry, in case clocks disagree
+EXPIRY_SLACK = 30
+
+
+def prefix_digest(config, model):
+    """Hash of everything the cache holds for config on model"""
+    prefix = config.model_dump_json(include={'system_instruction', 'tools', 'tool_config'})
+    return hashlib.sha256(f'{model}\n{prefix}'.encode('utf-8')).hexdigest()
+
+
+def rejects_cache(error):
+    """Whether a generate call failed because of its cached content
+
+    True for a missing or expired cache (404) and for errors that name the
+    cached content; False for quota (429) and other request errors, which an
+    inline resend would only repeat.
+    """
+    code = getattr(error, 'code', None)
+    if code == 429:
+        return False
+    message = str(error).lower()
+    return code == 404 or 'cachedcontent' in message or 'cached content' in message
+
+
+class _Entry:
+    __slots__ = ('config', 'model', 'digest', 'name', 'cached_config',
+                 'expires_at', 'retry_at', 'busy', 'error')
+
+    def __init__(self, config, model):
+        self.config = config
+        self.model = model
+        self.digest = None
+        self.name = None
+        self.cached_config = None
+        self.expires_at = 0.0
+        self.retry_at = 0.0
+        self.busy = False
+        self.error = None
+
+
+class ContextCacheManager:
+    """Cached prefixes for GenerateContentConfig objects, one per (config, model)
+
+    Configs are expected to be long-lived (the module-level configs in
+    chatbot_server.py); resolve() must not be given a fresh config per call.
+    """
+
+    def __init__(self, get_client, enabled=CONTEXT_CACHE_ENABLED, ttl=CONTEXT_CACHE_TTL,
+                 refresh_margin=CONTEXT_CACHE_REFRESH_MARGIN, retry=CONTEXT_CACHE_RETRY):
+        self._get_client = get_client
+        self.enabled = enabled
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.retry = retry
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.cached_requests = 0
+        self.inline_requests = 0
+
+    def resolve(self, config, model):
+        """Return the config to send: one referencing the cache when it is ready,
+        otherwise config itself"""
+        if not self.enabled or config.system_instruction is None:
+            return config
+
+        entry = self._entries.get((id(config), model))
+        if entry is None:
+            with self._lock:
+                entry = self._entries.setdefault((id(config), model), _Entry(config, model))
+
+        now = time.time()
+        if entry.cached_config is not None and now < entry.expires_at - EXPIRY_SLACK:
+            if now >= entry.expires_at - self.refresh_margin and now >= entry.retry_at:
+                self._refresh_later(entry)
+            self.cached_requests += 1
+            return entry.cached_config
+
+        if now >= entry.retry_at:
+            self._refresh_later(entry)
+        self.inline_requests += 1
+        return config
+
+    def invalidate(self, config, model, error=None):
+        """Stop using the cache for config, e.g. after the API rejected it
+
+        A new one is created after the retry delay.
+        """
+        entry = self._entries.get((id(config), model))
+        if entry is None:
+            return
+        entry.cached_config = None
+        entry.name = None
+        entry.error = str(error) if error else 'invalidated'
+        entry.retry_at = time.time() + self.retry
+
+    def _refresh_later(self, entry):
+        with self._lock:
+            if entry.busy:
+                return
+            entry.busy = True
+        threading.Thread(target=self._refresh, args=(entry,), daemon=True).start()
+
+    def _refresh(self, entry):
+        """Extend the entry's cache, or find or create one; runs off the request path"""
+        try:
+            client = self._get_client()
+            digest = prefix_digest(entry.config, entry.model)
+            cached = None
+            if entry.name and digest == entry.digest:
+                try:
+                    cached = client.caches.update(
+                        name=entry.name,
+                        config=types.UpdateCachedContentConfig(ttl=f'{self.ttl}s'),
+                    )
+                except Exception as e:
+                    print(f"Context cache refresh failed, recreating: {str(e)}")
+            if cached is None:
+                cached = self._find(client, digest) or self._create(client, entry, digest)
+
+            entry.digest = digest
+            entry.name = cached.name
+            entry.expires_at = cached.expire_time.timestamp() if cached.expire_time else time.time() + self.ttl
+            entry.cached_config = entry.config.model_copy(update={
+                'system_instruction': None,
+                'tools': None,
+                'tool_config': None,
+                'cached_content': cached.name,
+            })
+            entry.error = None
+        except Exception as e:
+            print(f"Context cache unavailable for {entry.model}: {str(e)}")
+            entry.error = str(e)
+            entry.retry_at = time.time() + self.retry
+        finally:
+            entry.busy = False
+
+    def _find(self, client, digest):
+        """A live cache for this prefix made by another worker or an earlier run"""
+        display_name = DISPLAY_PREFIX + digest[:32]
+        cutoff = time.time() + self.refresh_margin
+        for cached in client.caches.list():
+            if (cached.display_name == display_name and cached.expire_time
+                    and cached.expire_time.timestamp() > cutoff):
+                return cached
+        return None
+
+    def _create(self, client, entry, digest):
+        return client.caches.create(
+            model=entry.model,
+            config=types.CreateCachedContentConfig(
+                display_name=DISPLAY_PREFIX + digest[:32],
+                system_instruction=entry.config.system_instruction,
+                tools=entry.config.tools,
+                tool_config=entry.config.tool_config,
+                ttl=f'{self.ttl}s',
+            ),
+        )
+
+    def stats(self):
+        now = time.time()
+        return {
+            'enabled': self.enabled,
+            'cached_requests': self.cached_requests,
+            'inline_requests': self.inline_requests,
+            'caches': [
+                {
+                    'model': entry.model,
+                    'name': entry.name,
+                    'ready': entry.cached_config is not None,
+                    'expires_in': round(entry.expires_at - now) if entry.name else None,
+                    'error': entry.error,
+                }
+                for entry in list(self._entries.values())
+            ],
+        }
@@ -0,0 +1,262 @@
+"""Conversation history storage
+
+Two backends share one interface:
+
+- ``MemoryStore`` keeps sessions in-process, evicting idle sessions after a
+  TTL and the least recently used ones once a memory cap is reached.
+- ``SqliteStore`` keeps sessions in a SQLite database in WAL mode, so every
+  gunicorn worker on the host sees the same history.
+
+Pick one with CONVERSATION_STORE=memory|sqlite. It defaults to sqlite when
+WEB_CONCURRENCY asks for more than one worker (gunicorn.conf.py sets it for
+its own workers), since each worker would otherwise keep its own history.
+"""
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+CONVERSATION_STORE = os.environ.get(
+    'CONVERSATION_STORE', 'sqlite' if int(os.environ.get('WEB_CONCURRENCY', '1')) > 1 else 'memory',
+)
+CONVERSATION_DB = os.environ.get('CONVERSATION_DB', 'conversations.db')
+# Sessions idle for longer than this are dropped
+CONVERSATION_TTL = float(os.environ.get('CONVERSATION_TTL', '3600'))
+# Approximate cap on memory held by the in-memory backend
+CONVERSATION_MAX_BYTES = int(os.environ.get('CONVERSATION_MAX_BYTES', str(64 * 1024 * 1024)))
+# How often the SQLite backend purges idle sessions
+SWEEP_INTERVAL = 60
+
+
+class Turn:
+    """One message in a conversation"""
+
+    __slots__ = ('role', 'content')
+
+    def __init__(self, role, content):
+        self.role = role
+        self.content = content
+
+    def __repr__(self):
+        return f"Turn({self.role!r}, {self.content[:40]!r})"
+
+    def size(self):
+        """Approximate bytes held by this turn"""
+        return sys.getsizeof(self) + sys.getsizeof(self.content)
+
+
+class _Session:
+    __slots__ = ('turns', 'last_seen', 'size')
+
+    def __init__(self):
+        self.turns = []
+        self.last_seen = time.monotonic()
+        self.size = 0
+
+
+class MemoryStore:
+    """Per-process store with idle-TTL and LRU eviction under a memory cap"""
+
+    def __init__(self, ttl=CONVERSATION_TTL, max_bytes=CONVERSATION_MAX_BYTES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        # Ordered least to most recently used
+        self._sessions = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def history(self, session_id):
+        """Return a copy of the session's turns, oldest first"""
+        with self._lock:
+            self._expire()
+            session = self._touch(session_id)
+            return list(session.turns) if session else []
+
+    def append(self, session_id, role, content):
+        turn = Turn(role, content)
+        size = turn.size()
+        with self._lock:
+            session = self._touch(session_id)
+            if session is None:
+                session = self._sessions[session_id] = _Session()
+            session.turns.append(turn)
+            session.size += size
+            self._bytes += size
+            self._expire()
+            self._enforce_cap(keep=session_id)
+        return turn
+
+    def clear(self, session_id):
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+            if session:
+                self._bytes -= session.size
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': 'memory',
+                'sessions': len(self._sessions),
+                'turns': sum(len(s.turns) for s in self._sessions.values()),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'evictions': self.evictions,
+            }
+
+    def _touch(self, session_id):
+        session = self._sessions.get(session_id)
+        if session:
+            session.last_seen = time.monotonic()
+            self._sessions.move_to_end(session_id)
+        return session
+
+    def _expire(self):
+        # The oldest entry is the least recently used, so stop at the first live one
+        cutoff = time.monotonic() - self.ttl
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if session.last_seen > cutoff:
+                break
+            self._evict(session_id)
+
+    def _enforce_cap(self, keep):
+        while self._bytes > self.max_bytes and len(self._sessions) > 1:
+            session_id = next(iter(self._sessions))
+            if session_id == keep:
+                break
+            self._evict(session_id)
+
+    def _evict(self, session_id):
+        session = self._sessions.pop(session_id)
+        self._bytes -= session.size
+        self.evictions += 1
+
+
+class SqliteStore:
+    """Store shared by all workers through a SQLite database in WAL mode"""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS sessions (
+        session_id TEXT PRIMARY KEY,
+        turns INTEGER NOT NULL,
+        last_seen REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS sessions_last_seen ON sessions (last_seen);
+    CREATE TABLE IF NOT EXISTS turns (
+        session_id TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        PRIMARY KEY (session_id, seq)
+    ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path=CONVERSATION_DB, ttl=CONVERSATION_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        self._last_sweep = 0.0
+        self._conn().executescript(self.SCHEMA)
+
+    def _conn(self):
+        # One connection per thread, and never one inherited through fork()
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def history(self, session_id):
+        conn = self._conn()
+        now = time.time()
+        row = conn.execute(
+            'SELECT last_seen FROM sessions WHERE session_id = ?', (session_id,)
+        ).fetchone()
+        if row is None or row[0] < now - self.ttl:
+            return []
+        conn.execute(
+            'UPDATE sessions SET last_seen = ? WHERE session_id = ?', (now, session_id)
+        )
+        rows = conn.execute(
+            'SELECT role, content FROM turns WHERE session_id = ? ORDER BY seq',
+            (session_id,),
+        )
+        return [Turn(role, content) for role, content in rows]
+
+    def append(self, session_id, role, content):
+        conn = self._conn()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT turns, last_seen FROM sessions WHERE session_id = ?', (session_id,)
+            ).fetchone()
+            if row is not None and row[1] < now - self.ttl:
+                # Expired but not yet swept; start the session afresh
+                conn.execute('DELETE FROM turns WHERE session_id = ?', (session_id,))
+                row = None
+            seq = row[0] if row else 0
+            conn.execute(
+                'INSERT INTO turns (session_id, seq, role, content) VALUES (?, ?, ?, ?)',
+                (session_id, seq, role, content),
+            )
+            conn.execute(
+                'INSERT OR REPLACE INTO sessions (session_id, turns, last_seen) VALUES (?, ?, ?)',
+                (session_id, seq + 1, now),
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        self._maybe_sweep(now)
+        return Turn(role, content)
+
+    def clear(self, session_id):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('DELETE FROM turns WHERE session_id = ?', (session_id,))
+        conn.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
+        conn.execute('COMMIT')
+
+    def stats(self):
+        conn = self._conn()
+        sessions, turns = conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(turns), 0) FROM sessions'
+        ).fetchone()
+        return {
+            'backend': 'sqlite',
+            'path': self.path,
+            'sessions': sessions,
+            'turns': turns,
+            'ttl': self.ttl,
+        }
+
+    def _maybe_sweep(self, now):
+        if now - self._last_sweep < SWEEP_INTERVAL:
+            return
+        self._last_sweep = now
+        conn = self._conn()
+        cutoff = now - self.ttl
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute(
+            'DELETE FROM turns WHERE session_id IN '
+            '(SELECT session_id FROM sessions WHERE last_seen < ?)', (cutoff,)
+        )
+        conn.execute('DELETE FROM sessions WHERE last_seen < ?', (cutoff,))
+        conn.execute('COMMIT')
+
+
+def create_store(backend=CONVERSATION_STORE):
+    """Build the store selected by CONVERSATION_STORE"""
+    if backend == 'sqlite':
+        return SqliteStore()
+    if backend == 'memory':
+        return MemoryStore()
+    raise ValueError(f"Unknown CONVERSATION_STORE: {backend}")
@@ -0,0 +1,314 @@
+"""Deterministic local stand-in for the Gemini client
+
+Implements the parts of ``genai.Client`` the servers use
+(``models.generate_content_stream``, ``models.get`` and their ``aio``
+twins, and ``caches``) without any network access, so throughput and latency can be measured
+without spending API quota. Select it with MODEL_BACKEND=fake.
+
+Timing and failures are configurable through FAKE_* environment variables:
+
+- FAKE_TTFT: seconds before the first chunk
+- FAKE_TOKENS_PER_SECOND: streaming rate after the first chunk
+- FAKE_CHUNK_TOKENS: tokens per streamed chunk
+- FAKE_REPLY_TOKENS: length of every reply
+- FAKE_ERROR_RATE: fraction of calls that fail with a 503 before any chunk
+- FAKE_SLOW_RATE / FAKE_SLOW_FACTOR: fraction of calls whose first chunk is
+  FAKE_SLOW_FACTOR times later, to model tail latency
+- FAKE_THINKING_SECONDS: extra time to first chunk with unbounded thinking
+  (thinking_budget=-1); a fixed budget adds a share of it, up to 8192 tokens
+- FAKE_SEARCH_SECONDS: extra time to first chunk when the web search tool is
+  attached
+- FAKE_CACHE_MIN_TOKENS: smallest prefix ``caches.create`` accepts, as the
+  real API refuses small caches
+
+Replies and failures are derived from a hash of the prompt and FAKE_SEED,
+so a replayed workload behaves the same way every run.
+"""
+import asyncio
+import datetime
+import hashlib
+import itertools
+import os
+import random
+import threading
+import time
+from collections import deque
+from types import SimpleNamespace
+
+from google.genai import errors
+from google.genai import types
+
+WORDS = (
+    "policy claim coverage premium deductible adjuster payment branch portal "
+    "renewal driver vehicle property liability document upload review approve "
+    "select open click save confirm module settings account support"
+).split()
+
+
+def _env(name, default):
+    return float(os.environ.get(name, default))
+
+
+class FakeSettings:
+    def __init__(self, ttft=None, tokens_per_second=None, chunk_tokens=None,
+                 reply_tokens=None, error_rate=None, slow_rate=None,
+                 slow_factor=None, seed=None, cache_min_tokens=None,
+                 thinking_seconds=None, search_seconds=None):
+        self.ttft = _env('FAKE_TTFT', '0.4') if ttft is None else ttft
+        self.tokens_per_second = _env('FAKE_TOKENS_PER_SECOND', '200') if tokens_per_second is None else tokens_per_second
+        self.chunk_tokens = int(_env('FAKE_CHUNK_TOKENS', '8') if chunk_tokens is None else chunk_tokens)
+        self.reply_tokens = int(_env('FAKE_REPLY_TOKENS', '160') if reply_tokens is None else reply_tokens)
+        self.error_rate = _env('FAKE_ERROR_RATE', '0') if error_rate is None else error_rate
+        self.slow_rate = _env('FAKE_SLOW_RATE', '0') if slow_rate is None else slow_rate
+        self.slow_factor = _env('FAKE_SLOW_FACTOR', '10') if slow_factor is None else slow_factor
+        self.seed = int(_env('FAKE_SEED', '0') if seed is None else seed)
+        self.thinking_seconds = _env('FAKE_THINKING_SECONDS', '0.6') if thinking_seconds is None else thinking_seconds
+        self.search_seconds = _env('FAKE_SEARCH_SECONDS', '0.5') if search_seconds is None else search_seconds
+        self.cache_min_tokens = int(_env('FAKE_CACHE_MIN_TOKENS', '1024') if cache_min_tokens is None else cache_min_tokens)
+
+
+def has_search(tools):
+    return any(tool.google_search is not None for tool in tools or [])
+
+
+def thinking_share(config):
+    """0 for no thinking, 1 for unbounded, a fraction for a fixed budget"""
+    thinking = config.thinking_config if config else None
+    budget = thinking.thinking_budget if thinking else None
+    if not budget:
+        return 0.0
+    return 1.0 if budget < 0 else min(1.0, budget / 8192)
+
+
+def estimate_tokens(value):
+    """Rough token count of a str, Part, Content or list of them"""
+    if value is None:
+        return 0
+    if isinstance(value, str):
+        return len(value) // 4 + 1
+    if isinstance(value, list):
+        return sum(estimate_tokens(item) for item in value)
+    if isinstance(value, types.Content):
+        return estimate_tokens(value.parts or [])
+    return estimate_tokens(value.text or '')
+
+
+def prompt_digest(settings, contents):
+    digest = hashlib.sha256(str(settings.seed).encode())
+    for content in contents or []:
+        for part in content.parts or []:
+            digest.update((part.text or '').encode('utf-8'))
+    return digest.digest()
+
+
+class _Plan:
+    """What one fake call will do, decided up front from the prompt
+
+    The reply depends only on the prompt; failures and slow starts also
+    depend on how many times this prompt was sent, so a retry can succeed.
+    """
+
+    def __init__(self, settings, contents, digest, attempt, prefix_tokens=0, cached=False,
+                 error=None, extra_ttft=0.0):
+        faults = random.Random(digest + attempt.to_bytes(4, 'big'))
+        self.fail = faults.random() < settings.error_rate or error is not None
+        self._error = error
+        base = settings.ttft + extra_ttft
+        self.ttft = base * (settings.slow_factor if faults.random() < settings.slow_rate else 1)
+
+        rng = random.Random(digest)
+        words = [rng.choice(WORDS) for _ in range(settings.reply_tokens)]
+        size = max(1, settings.chunk_tokens)
+        self.chunks = [' '.join(words[i:i + size]) + ' ' for i in range(0, len(words), size)]
+        self.chunk_delay = size / settings.tokens_per_second if settings.tokens_per_second else 0
+        self.reply_tokens = len(words)
+        # The prefix is the system instruction, sent inline or from a cache
+        self.cached_tokens = prefix_tokens if cached else 0
+        self.prompt_tokens = estimate_tokens(contents or []) + prefix_tokens
+
+    def response(self, index):
+        last = index == len(self.chunks) - 1
+        return types.GenerateContentResponse(
+            candidates=[types.Candidate(
+                content=types.Content(role='model', parts=[types.Part(text=self.chunks[index])]),
+                finish_reason=types.FinishReason.STOP if last else None,
+            )],
+            usage_metadata=types.GenerateContentResponseUsageMetadata(
+                prompt_token_count=self.prompt_tokens,
+                cached_content_token_count=self.cached_tokens or None,
+                candidates_token_count=self.reply_tokens,
+                total_token_count=self.prompt_tokens + self.reply_tokens,
+            ) if last else None,
+        )
+
+    def error(self):
+        if self._error is not None:
+            return self._error
+        return errors.ServerError(503, {'error': {
+            'code': 503, 'message': 'The model is overloaded (fake backend).', 'status': 'UNAVAILABLE',
+        }})
+
+
+class FakeClient:
+    """Drop-in for genai.Client backed by FakeSettings
+
+    Every generate call is recorded in ``calls`` (the most recent 1000) as a
+    dict with the model, the number of contents, the config object and the
+    cached content it referenced (None when the prefix was sent inline).
+    """
+
+    def __init__(self, settings=None):
+        self.settings = settings or FakeSettings()
+        self.calls = deque(maxlen=1000)
+        self.call_count = 0
+        self._attempts = {}
+        self._lock = threading.Lock()
+        self.models = _Models(self)
+        self.caches = _Caches(self)
+        self.aio = SimpleNamespace(models=_AsyncModels(self))
+
+    def _record(self, model, contents, config):
+        digest = prompt_digest(self.settings, contents)
+        cache_name = config.cached_content if config else None
+        if cache_name:
+            prefix_tokens, search, error = self.caches._use(cache_name)
+        else:
+            prefix_tokens = estimate_tokens(config.system_instruction) if config else 0
+            search, error = has_search(config.tools if config else None), None
+        extra_ttft = (thinking_share(config) * self.settings.thinking_seconds
+                      + (self.settings.search_seconds if search else 0))
+        with self._lock:
+            self.call_count += 1
+            self.calls.append({
+                'model': model,
+                'contents': len(contents or []),
+                'config': config,
+                'cached_content': cache_name,
+            })
+            if len(self._attempts) > 10000:
+                self._attempts.clear()
+            attempt = self._attempts[digest] = self._attempts.get(digest, 0) + 1
+        return _Plan(self.settings, contents, digest, attempt, prefix_tokens, bool(cache_name),
+                     error, extra_ttft)
+
+
+class _Models:
+    def __init__(self, client):
+        self._client = client
+
+    def generate_content_stream(self, model, contents, config=None):
+        plan = self._client._record(model, contents, config)
+        return self._stream(plan)
+
+    def _stream(self, plan):
+        time.sleep(plan.ttft)
+        if plan.fail:
+            raise plan.error()
+        for index in range(len(plan.chunks)):
+            if index:
+                time.sleep(plan.chunk_delay)
+            yield plan.response(index)
+
+    def get(self, model):
+        return types.Model(name=f'models/{model}')
+
+
+class _AsyncModels:
+    def __init__(self, client):
+        self._client = client
+
+    async def generate_content_stream(self, model, contents, config=None):
+        plan = self._client._record(model, contents, config)
+        return self._stream(plan)
+
+    async def _stream(self, plan):
+        await asyncio.sleep(plan.ttft)
+        if plan.fail:
+            raise plan.error()
+        for index in range(len(plan.chunks)):
+            if index:
+                await asyncio.sleep(plan.chunk_delay)
+            yield plan.response(index)
+
+    async def get(self, model):
+        return types.Model(name=f'models/{model}')
+
+
+class _Caches:
+    """In-memory ``client.caches`` with TTL expiry"""
+
+    def __init__(self, client):
+        self._client = client
+        self._caches = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _live(self, name):
+        entry = self._caches.get(name)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if entry is None or entry['cached'].expire_time <= now:
+            raise errors.ClientError(404, {'error': {
+                'code': 404, 'message': f'CachedContent not found: {name}', 'status': 'NOT_FOUND',
+            }})
+        return entry
+
+    def _use(self, name):
+        """(cached tokens, search tool cached, error) for a generate call referencing name"""
+        with self._lock:
+            try:
+                entry = self._live(name)
+                return entry['tokens'], entry['search'], None
+            except errors.ClientError as e:
+                return 0, False, e
+
+    @staticmethod
+    def _expiry(ttl):
+        seconds = float(ttl.rstrip('s')) if ttl else 3600
+        return datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=seconds)
+
+    def create(self, model, config=None):
+        tokens = estimate_tokens(config.system_instruction) + estimate_tokens(config.contents)
+        # Tool declarations count towards the prefix too
+        tokens += 50 * len(config.tools or [])
+        if tokens < self._client.settings.cache_min_tokens:
+            raise errors.ClientError(400, {'error': {
+                'code': 400,
+                'message': f'Cached content is too small. total_token_count={tokens}, '
+                           f'min_total_token_count={self._client.settings.cache_min_tokens}',
+                'status': 'INVALID_ARGUMENT',
+            }})
+        with self._lock:
+            name = f'cachedContents/fake-{next(self._ids)}'
+            now = datetime.datetime.now(datetime.timezone.utc)
+            cached = types.CachedContent(
+                name=name,
+                display_name=config.display_name,
+                model=f'models/{model}',
+                create_time=now,
+                update_time=now,
+                expire_time=self._expiry(config.ttl),
+                usage_metadata=types.CachedContentUsageMetadata(total_token_count=tokens),
+            )
+            self._caches[name] = {'cached': cached, 'tokens': tokens, 'search': has_search(config.tools)}
+            return cached
+
+    def get(self, name):
+        with self._lock:
+            return self._live(name)['cached']
+
+    def update(self, name, config=None):
+        with self._lock:
+            cached = self._live(name)['cached']
+            cached.expire_time = self._expiry(config.ttl if config else None)
+            cached.update_time = datetime.datetime.now(datetime.timezone.utc)
+            return cached
+
+    def delete(self, name):
+        with self._lock:
+            self._live(name)
+            del self._caches[name]
+
+    def list(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        with self._lock:
+            return iter([e['cached'] for e in self._caches.values() if e['cached'].expire_time > now])
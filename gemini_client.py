@@ -0,0 +1,113 @@
+"""Process-wide Google AI client with pooled upstream connections"""
+import os
+import threading
+import time
+
+import httpx
+from google import genai
+from google.genai import types
+
+MODEL = os.environ.get('GEMINI_MODEL', 'gemini-flash-latest')
+# 'gemini' for the real API, 'fake' for the local stand-in in fake_backend.py
+MODEL_BACKEND = os.environ.get('MODEL_BACKEND', 'gemini')
+
+# Connection pool tuning (per worker process)
+POOL_MAX_CONNECTIONS = int(os.environ.get('GEMINI_POOL_MAX_CONNECTIONS', '32'))
+POOL_MAX_KEEPALIVE = int(os.environ.get('GEMINI_POOL_MAX_KEEPALIVE', '16'))
+POOL_KEEPALIVE_EXPIRY = float(os.environ.get('GEMINI_POOL_KEEPALIVE_EXPIRY', '120'))
+# Each concurrent stream holds a connection, and the async server runs hundreds
+ASYNC_POOL_MAX_CONNECTIONS = int(os.environ.get('GEMINI_ASYNC_POOL_MAX_CONNECTIONS', '512'))
+ASYNC_POOL_MAX_KEEPALIVE = int(os.environ.get('GEMINI_ASYNC_POOL_MAX_KEEPALIVE', '64'))
+# Seconds any one read (and the server-side deadline) may take. Without it the
+# SDK waits forever, and a stalled stream abandoned by resilience.py would
+# keep its thread and pooled connection. Keep it at least UPSTREAM_TIMEOUT.
+HTTP_TIMEOUT = float(os.environ.get('GEMINI_HTTP_TIMEOUT', os.environ.get('UPSTREAM_TIMEOUT', '120')))
+
+_client = None
+_client_pid = None
+_lock = threading.Lock()
+_warm_up = {'ok': False, 'at': None, 'elapsed': None, 'error': None}
+
+
+def _pool_args(max_connections, max_keepalive):
+    """Keyword arguments for the httpx clients the SDK builds"""
+    return {
+        'limits': httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=POOL_KEEPALIVE_EXPIRY,
+        ),
+    }
+
+
+def get_client():
+    """Return the client for this process, creating it on first use"""
+    global _client, _client_pid
+
+    # A client inherited through fork() would share sockets with the parent,
+    # so every worker builds its own
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _lock:
+            if _client is None or _client_pid != pid:
+                _client = _create_client()
+                _client_pid = pid
+    return _client
+
+
+def _create_client():
+    if MODEL_BACKEND == 'fake':
+        import fake_backend
+        return fake_backend.FakeClient()
+    if MODEL_BACKEND != 'gemini':
+        raise ValueError(f"Unknown MODEL_BACKEND: {MODEL_BACKEND}")
+    return genai.Client(
+        api_key=os.environ.get("GEMINI_API_KEY"),
+        http_options=types.HttpOptions(
+            # In milliseconds
+            timeout=int(HTTP_TIMEOUT * 1000),
+            client_args=_pool_args(POOL_MAX_CONNECTIONS, POOL_MAX_KEEPALIVE),
+            async_client_args=_pool_args(ASYNC_POOL_MAX_CONNECTIONS, ASYNC_POOL_MAX_KEEPALIVE),
+        ),
+    )
+
+
+def warm_up(model=MODEL):
+    """Open the upstream connection before the worker takes traffic"""
+    started = time.time()
+    try:
+        # A metadata lookup is cheap and completes the TLS handshake,
+        # leaving a keep-alive connection in the pool
+        get_client().models.get(model=model)
+        _warm_up.update(ok=True, error=None)
+    except Exception as e:
+        print(f"Warm-up failed: {str(e)}")
+        _warm_up.update(ok=False, error=str(e))
+    _warm_up.update(at=time.time(), elapsed=round(time.time() - started, 3))
+    return _warm_up['ok']
+
+
+async def warm_up_async(model=MODEL):
+    """warm_up for the async client's connection pool"""
+    started = time.time()
+    try:
+        await get_client().aio.models.get(model=model)
+        _warm_up.update(ok=True, error=None)
+    except Exception as e:
+        print(f"Warm-up failed: {str(e)}")
+        _warm_up.update(ok=False, error=str(e))
+    _warm_up.update(at=time.time(), elapsed=round(time.time() - started, 3))
+    return _warm_up['ok']
+
+
+def client_status():
+    """Summarise client and warm-up state for health checks"""
+    return {
+        'model': MODEL,
+        'backend': MODEL_BACKEND,
+        'initialized': _client is not None and _client_pid == os.getpid(),
+        'warm': _warm_up['ok'],
+        'warmed_at': _warm_up['at'],
+        'warm_up_seconds': _warm_up['elapsed'],
+        'warm_up_error': _warm_up['error'],
+    }
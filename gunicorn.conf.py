@@ -0,0 +1,77 @@
+# Gunicorn settings for the Infoins V4 chatbot
+# Usage: gunicorn -c gunicorn.conf.py chatbot_server:app
+import glob
+import os
+import shutil
+import tempfile
+
+import admission
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('WEB_CONCURRENCY', '2'))
+# Every chat request holds a thread while it waits at the upstream gate, so a
+# worker needs ADMISSION_MAX_IN_FLIGHT + ADMISSION_MAX_QUEUE threads for the
+# gate's queue to fill and shed with 503s, plus a few for health checks and
+# static files. With fewer, requests pile up in gunicorn's backlog instead.
+threads = int(os.environ.get(
+    'GUNICORN_THREADS', admission.MAX_IN_FLIGHT + admission.MAX_QUEUE + 4,
+))
+if threads < admission.MAX_IN_FLIGHT + admission.MAX_QUEUE:
+    print(f"GUNICORN_THREADS={threads} is below ADMISSION_MAX_IN_FLIGHT + ADMISSION_MAX_QUEUE "
+          f"({admission.MAX_IN_FLIGHT + admission.MAX_QUEUE}); excess requests will wait "
+          f"in the listen backlog instead of being shed")
+worker_class = 'gthread'
+# Workers share conversation history through SQLite (see conversation_store.py)
+if workers > 1:
+    os.environ.setdefault('CONVERSATION_STORE', 'sqlite')
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '120'))
+keepalive = 5
+
+# Workers write their metrics here so /metrics on any of them reports the total.
+# Set before the workers import prometheus_client, which reads it on import.
+# A directory the operator chose is kept; only its sample files are ours.
+_own_metrics_dir = 'PROMETHEUS_MULTIPROC_DIR' not in os.environ
+os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR',
+    os.path.join(tempfile.gettempdir(), f'infoins-metrics-{os.getpid()}'),
+)
+
+
+def _remove_samples(metrics_dir):
+    for path in glob.glob(os.path.join(metrics_dir, '*.db')):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def on_starting(server):
+    """Drop samples left by a previous run"""
+    metrics_dir = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    os.makedirs(metrics_dir, exist_ok=True)
+    _remove_samples(metrics_dir)
+
+
+def on_exit(server):
+    metrics_dir = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    if _own_metrics_dir:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+    else:
+        _remove_samples(metrics_dir)
+
+
+def child_exit(server, worker):
+    """Stop counting a dead worker's gauges"""
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def post_worker_init(worker):
+    """Open the upstream connection before this worker accepts requests"""
+    import gemini_client
+    import retrieval
+    retrieval.get_index()
+    if gemini_client.warm_up():
+        worker.log.info("Worker %s warmed up upstream client", worker.pid)
+    else:
+        worker.log.warning("Worker %s started without a warm upstream client", worker.pid)
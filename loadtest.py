@@ -0,0 +1,388 @@
+"""Load generator and regression gate for the chat servers
+
+Replays a JSONL workload (or synthetic multi-turn sessions) against a running
+server, or spawns the server itself on the fake model backend for each
+requested worker count, and reports latency, time-to-first-token, throughput
+and worker memory growth.
+
+Examples:
+
+  # Spawn the async server on the fake backend with 1, 2 and 4 workers
+  python loadtest.py --spawn asgi --workers 1,2,4 --synthetic 200 --turns 3
+
+  # Replay a JSONL file against a server that is already running
+  python loadtest.py --url http://localhost:5000 --input requests.jsonl
+
+  # Latency per model tier, with routing as configured or everything on one tier
+  python loadtest.py --spawn asgi --input questions.jsonl
+  python loadtest.py --spawn asgi --input questions.jsonl --env ROUTING_FORCE_TIER=full
+
+  # Fail (exit 1) if p95 latency, TTFT or throughput regress more than 10%
+  python loadtest.py --spawn flask --baseline baseline.json --max-regression 0.1
+
+Each JSONL line is an object with the message in 'message' (falling back to
+'body' or 'title') and an optional 'session_id'; lines that share a
+session_id are replayed in order as one conversation.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import uuid
+
+import httpx
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_jsonl(path, limit=None):
+    """Group JSONL lines into sessions (lists of messages)"""
+    sessions = {}
+    with open(path, encoding='utf-8') as f:
+        for number, line in enumerate(f):
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            message = entry.get('message') or entry.get('body') or entry.get('title')
+            if not message:
+                continue
+            session = entry.get('session_id') or f'line-{number}'
+            sessions.setdefault(session, []).append(message)
+            if limit and len(sessions) >= limit:
+                break
+    return list(sessions.values())
+
+
+def synthetic_sessions(count, turns, seed, exact=False):
+    """Multi-turn sessions built from faq.txt questions
+
+    Unless exact is set each message gets a reference suffix, so the FAQ and
+    response caches do not answer it and the model path is exercised.
+    """
+    import retrieval
+
+    questions = [pair['question'] for pair in retrieval.parse_faq()]
+    rng = random.Random(seed)
+    sessions = []
+    for s in range(count):
+        messages = []
+        for t in range(turns):
+            question = rng.choice(questions)
+            messages.append(question if exact else f"{question} (case {s}-{t})")
+        sessions.append(messages)
+    return sessions
+
+
+class Result:
+    __slots__ = ('status', 'latency', 'ttft', 'error', 'tier')
+
+    def __init__(self, status, latency, ttft=None, error=None, tier=None):
+        self.status = status
+        self.latency = latency
+        self.ttft = ttft
+        self.error = error
+        # Model tier the server routed to; None for cached or shared replies
+        self.tier = tier
+
+
+async def send(client, endpoint, message, session_id):
+    """Send one message; return a Result with latency and time to first text"""
+    started = time.perf_counter()
+    payload = {'message': message, 'session_id': session_id}
+    try:
+        if endpoint == 'chat':
+            response = await client.post('/api/chat', json=payload)
+            elapsed = time.perf_counter() - started
+            tier = response.json().get('tier') if response.status_code == 200 else None
+            return Result(response.status_code, elapsed, elapsed, tier=tier)
+
+        ttft = None
+        error = None
+        tier = None
+        event = None
+        async with client.stream('POST', '/api/chat/stream', json=payload) as response:
+            if response.status_code != 200:
+                await response.aread()
+                return Result(response.status_code, time.perf_counter() - started)
+            async for line in response.aiter_lines():
+                if line.startswith('event:'):
+                    event = line[6:].strip()
+                    if event == 'error':
+                        error = 'stream error'
+                elif line.startswith('data:'):
+                    if ttft is None:
+                        ttft = time.perf_counter() - started
+                    if event == 'done':
+                        tier = json.loads(line[5:]).get('tier')
+                    event = None
+        status = 599 if error else 200
+        return Result(status, time.perf_counter() - started, ttft, error, tier)
+    except httpx.HTTPError as e:
+        return Result(0, time.perf_counter() - started, error=type(e).__name__)
+
+
+async def run_load(url, sessions, concurrency, endpoint, timeout):
+    """Run every session through concurrency virtual users"""
+    queue = asyncio.Queue()
+    for messages in sessions:
+        queue.put_nowait(messages)
+    results = []
+    run_id = uuid.uuid4().hex[:8]
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=timeout) as client:
+        async def user(number):
+            while not queue.empty():
+                messages = queue.get_nowait()
+                session_id = f'load-{run_id}-{number}-{queue.qsize()}'
+                for message in messages:
+                    results.append(await send(client, endpoint, message, session_id))
+
+        started = time.perf_counter()
+        await asyncio.gather(*(user(i) for i in range(concurrency)))
+        wall = time.perf_counter() - started
+    return results, wall
+
+
+def summarize(results, wall):
+    ok = [r for r in results if r.status == 200]
+    statuses = {}
+    for r in results:
+        statuses[str(r.status)] = statuses.get(str(r.status), 0) + 1
+
+    def percentiles(values):
+        if not values:
+            return {'p50': None, 'p95': None, 'p99': None}
+        arr = np.array(values) * 1000
+        return {p: round(float(np.percentile(arr, int(p[1:]))), 1) for p in ('p50', 'p95', 'p99')}
+
+    tiers = {}
+    for r in ok:
+        tiers.setdefault(r.tier or 'cached/shared', []).append(r)
+
+    return {
+        'requests': len(results),
+        'ok': len(ok),
+        'error_rate': round(1 - len(ok) / len(results), 4) if results else 0,
+        'statuses': statuses,
+        'wall_seconds': round(wall, 2),
+        'throughput_rps': round(len(ok) / wall, 2) if wall else 0,
+        'latency_ms': percentiles([r.latency for r in ok]),
+        'ttft_ms': percentiles([r.ttft for r in ok if r.ttft is not None]),
+        'tiers': {
+            tier: {
+                'requests': len(rs),
+                'latency_ms': percentiles([r.latency for r in rs]),
+                'ttft_ms': percentiles([r.ttft for r in rs if r.ttft is not None]),
+            }
+            for tier, rs in sorted(tiers.items())
+        },
+    }
+
+
+def process_tree(pid):
+    """pid and all of its descendants, from /proc"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree = [pid]
+    for p in tree:
+        tree.extend(children.get(p, []))
+    return tree
+
+
+def worker_rss(pid):
+    """Resident memory (MiB) of each worker process under the server pid"""
+    rss = {}
+    tree = process_tree(pid)
+    workers = tree[1:] or tree
+    for p in workers:
+        try:
+            with open(f'/proc/{p}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        rss[p] = int(line.split()[1]) / 1024
+        except OSError:
+            continue
+    return rss
+
+
+def spawn_server(kind, workers, port, extra_env):
+    env = dict(os.environ)
+    env.update({
+        'MODEL_BACKEND': 'fake',
+        # The load comes from one IP and many sessions; measure the server, not the limiter
+        'RATE_LIMIT_IP_RATE': '1000000',
+        'RATE_LIMIT_IP_BURST': '1000000',
+        'RATE_LIMIT_SESSION_RATE': '1000000',
+        'RATE_LIMIT_SESSION_BURST': '1000000',
+        'WEB_CONCURRENCY': str(workers),
+        'ROUTING_LOG': '0',
+    })
+    env.update(extra_env)
+
+    if kind == 'flask':
+        command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+                   '--bind', f'127.0.0.1:{port}', '--workers', str(workers),
+                   '--log-level', 'warning', 'chatbot_server:app']
+    else:
+        command = [sys.executable, '-m', 'uvicorn', 'asgi_server:app',
+                   '--host', '127.0.0.1', '--port', str(port), '--workers', str(workers),
+                   '--log-level', 'warning']
+    process = subprocess.Popen(command, cwd=BASE_DIR, env=env)
+
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{kind} server exited with code {process.returncode}")
+        try:
+            if httpx.get(f'http://127.0.0.1:{port}/api/health', timeout=1).status_code == 200:
+                # Give every worker time to finish warming up
+                time.sleep(1)
+                return process
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.25)
+    process.terminate()
+    raise RuntimeError(f"{kind} server did not become healthy")
+
+
+def run_case(args, sessions, workers=None):
+    process = None
+    url = args.url
+    if args.spawn:
+        process = spawn_server(args.spawn, workers, args.port, dict(args.env))
+        url = f'http://127.0.0.1:{args.port}'
+    try:
+        rss_before = worker_rss(process.pid) if process else {}
+        results, wall = asyncio.run(run_load(url, sessions, args.concurrency, args.endpoint, args.timeout))
+        rss_after = worker_rss(process.pid) if process else {}
+    finally:
+        if process:
+            process.terminate()
+            process.wait(timeout=30)
+
+    report = summarize(results, wall)
+    report['workers'] = workers
+    if rss_before:
+        before = sum(rss_before.values()) / len(rss_before)
+        after = sum(rss_after.values()) / len(rss_after) if rss_after else before
+        report['worker_rss_mib'] = {
+            'before': round(before, 1),
+            'after': round(after, 1),
+            'growth': round(after - before, 1),
+        }
+    return report
+
+
+def print_report(report):
+    label = f"{report['workers']} worker(s)" if report['workers'] else 'target'
+    print(f"\n== {label}: {report['requests']} requests, {report['ok']} ok, "
+          f"{report['throughput_rps']} req/s over {report['wall_seconds']}s")
+    print(f"   latency ms  {report['latency_ms']}")
+    print(f"   ttft ms     {report['ttft_ms']}")
+    print(f"   statuses    {report['statuses']}")
+    for tier, stats in report['tiers'].items():
+        print(f"   {tier:<13} {stats['requests']:>5} req  latency p50/p95 "
+              f"{stats['latency_ms']['p50']}/{stats['latency_ms']['p95']} ms  "
+              f"ttft p50/p95 {stats['ttft_ms']['p50']}/{stats['ttft_ms']['p95']} ms")
+    if 'worker_rss_mib' in report:
+        print(f"   worker RSS  {report['worker_rss_mib']} MiB")
+
+
+def compare(reports, baseline, tolerance):
+    """Return a list of regressions against a baseline report file"""
+    previous = {str(r['workers']): r for r in baseline['cases']}
+    regressions = []
+    for report in reports:
+        base = previous.get(str(report['workers']))
+        if not base:
+            continue
+        label = f"workers={report['workers']}"
+        for metric in ('latency_ms', 'ttft_ms'):
+            new, old = report[metric]['p95'], base[metric]['p95']
+            if new is not None and old and new > old * (1 + tolerance):
+                regressions.append(f"{label}: {metric} p95 {old} -> {new}")
+        if report['throughput_rps'] < base['throughput_rps'] * (1 - tolerance):
+            regressions.append(f"{label}: throughput {base['throughput_rps']} -> {report['throughput_rps']} req/s")
+        if report['error_rate'] > base['error_rate'] + 0.01:
+            regressions.append(f"{label}: error rate {base['error_rate']} -> {report['error_rate']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog='\n'.join(__doc__.splitlines()[2:]),
+    )
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--url', help='server already running, e.g. http://localhost:5000')
+    target.add_argument('--spawn', choices=('flask', 'asgi'), help='start this server on the fake backend')
+    parser.add_argument('--workers', default='1', help='comma-separated worker counts for --spawn')
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--env', action='append', default=[], type=lambda s: s.split('=', 1),
+                        metavar='NAME=VALUE', help='extra environment for the spawned server (FAKE_TTFT=0.8, ...)')
+
+    workload = parser.add_mutually_exclusive_group()
+    workload.add_argument('--input', help='JSONL workload to replay')
+    workload.add_argument('--synthetic', type=int, default=100, help='number of synthetic sessions')
+    parser.add_argument('--turns', type=int, default=3, help='turns per synthetic session')
+    parser.add_argument('--exact', action='store_true', help='send FAQ questions verbatim (cache-friendly)')
+    parser.add_argument('--limit', type=int, help='replay at most this many sessions from --input')
+    parser.add_argument('--seed', type=int, default=1)
+
+    parser.add_argument('--concurrency', type=int, default=32, help='virtual users')
+    parser.add_argument('--endpoint', choices=('stream', 'chat'), default='stream')
+    parser.add_argument('--timeout', type=float, default=120)
+
+    parser.add_argument('--report', help='write the JSON report here')
+    parser.add_argument('--baseline', help='JSON report to compare against')
+    parser.add_argument('--max-regression', type=float, default=0.1)
+    args = parser.parse_args()
+
+    if args.input:
+        sessions = load_jsonl(args.input, args.limit)
+    else:
+        sessions = synthetic_sessions(args.synthetic, args.turns, args.seed, args.exact)
+    print(f"Workload: {len(sessions)} sessions, {sum(len(s) for s in sessions)} messages, "
+          f"concurrency {args.concurrency}, endpoint /api/{'chat/stream' if args.endpoint == 'stream' else 'chat'}")
+
+    worker_counts = [int(w) for w in args.workers.split(',')] if args.spawn else [None]
+    reports = []
+    for workers in worker_counts:
+        report = run_case(args, sessions, workers)
+        print_report(report)
+        reports.append(report)
+
+    output = {'server': args.spawn or args.url, 'endpoint': args.endpoint, 'cases': reports}
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(output, f, indent=2)
+        print(f"\nReport written to {args.report}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(reports, json.load(f), args.max_regression)
+        if regressions:
+            print("\n❌ Regressions against baseline:")
+            for line in regressions:
+                print(f"   {line}")
+            sys.exit(1)
+        print("\n✅ No regressions against baseline")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+"""Prometheus metrics for the chat servers
+
+Each chat request carries a ``RequestTimer`` that records how long every
+stage took; the stages are observed together when the request finishes, so
+they share its tier and outcome labels:
+
+- rate_limit: the per-IP and per-session token buckets
+- queue: waiting for an upstream slot (admission.py)
+- setup: client lookup and knowledge-base grounding, which picks the config
+- build_contents: turning the session history into the prompt
+- first_chunk: from starting the upstream call to the first reply text
+- stream: from starting the upstream call to the last reply text
+- serialize: JSON / SSE encoding of the reply
+
+Token counts come from the model's usage metadata, once per upstream call.
+Retries, hedged attempts, deadline misses and circuit breaker trips are
+counted by event.
+
+Under gunicorn every worker writes its samples to PROMETHEUS_MULTIPROC_DIR
+(gunicorn.conf.py sets it up) and /metrics on any worker reports the sum over
+all of them. Without it the numbers are per process.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    REGISTRY,
+    generate_latest,
+    multiprocess,
+)
+
+import conversation_store
+import gemini_client
+
+MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+# Scrapes within this many seconds get the same rendered page
+METRICS_CACHE_SECONDS = float(os.environ.get('METRICS_CACHE_SECONDS', '1'))
+# How often each worker refreshes the conversation store gauges
+STORE_REFRESH_SECONDS = float(os.environ.get('METRICS_STORE_REFRESH_SECONDS', '5'))
+
+# From a token-bucket check (well under a millisecond) to a long streamed answer
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1, 2.5, 5, 10, 20, 40, 80,
+)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536)
+
+STAGE_SECONDS = Histogram(
+    'chat_stage_seconds', 'Time spent in each stage of a chat request',
+    ['endpoint', 'stage', 'tier', 'model', 'outcome'], buckets=LATENCY_BUCKETS,
+)
+REQUESTS = Counter(
+    'chat_requests', 'Chat requests by outcome',
+    ['endpoint', 'tier', 'model', 'outcome'],
+)
+MESSAGE_BYTES = Histogram(
+    'chat_message_bytes', 'Size of the user message',
+    ['endpoint'], buckets=SIZE_BUCKETS,
+)
+REPLY_BYTES = Histogram(
+    'chat_reply_bytes', 'Size of the reply sent back',
+    ['endpoint', 'model'], buckets=SIZE_BUCKETS,
+)
+UPSTREAM_CALLS = Counter(
+    'chat_upstream_calls', 'Upstream model calls', ['model'],
+)
+UPSTREAM_TOKENS = Counter(
+    'chat_upstream_tokens', 'Tokens reported in upstream usage metadata',
+    ['model', 'kind'],
+)
+UPSTREAM_EVENTS = Counter(
+    'chat_upstream_events', 'Retries, hedges, timeouts and circuit breaker trips (resilience.py)',
+    ['event'],
+)
+
+_store = None
+_store_gauges = {}
+_store_refreshed = 0.0
+_store_lock = threading.Lock()
+
+_page = (0.0, b'')
+_page_lock = threading.Lock()
+
+
+class RequestTimer:
+    """Stage timings for one request, observed together by finish()"""
+
+    __slots__ = ('endpoint', 'model', 'tier', 'stages', 'finished')
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.model = gemini_client.MODEL
+        # Set once the request is routed; cached and shared replies have none
+        self.tier = None
+        self.stages = {}
+        self.finished = False
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def finish(self, outcome, message=None, reply=None):
+        """Observe every stage under outcome; later calls are ignored"""
+        if self.finished:
+            return
+        self.finished = True
+        tier = self.tier or 'none'
+        for name, seconds in self.stages.items():
+            STAGE_SECONDS.labels(self.endpoint, name, tier, self.model, outcome).observe(seconds)
+        REQUESTS.labels(self.endpoint, tier, self.model, outcome).inc()
+        if message is not None:
+            MESSAGE_BYTES.labels(self.endpoint).observe(len(message.encode('utf-8')))
+        if reply is not None:
+            REPLY_BYTES.labels(self.endpoint, self.model).observe(len(reply.encode('utf-8')))
+        _maybe_refresh_store()
+
+
+def record_usage(model, usage):
+    """Count one upstream call and the tokens in its usage metadata (may be None)"""
+    UPSTREAM_CALLS.labels(model).inc()
+    if usage is None:
+        return
+    for kind, count in (
+        ('prompt', usage.prompt_token_count),
+        ('cached', usage.cached_content_token_count),
+        ('response', usage.candidates_token_count),
+        ('thoughts', usage.thoughts_token_count),
+    ):
+        if count:
+            UPSTREAM_TOKENS.labels(model, kind).inc(count)
+
+
+def record_upstream_event(event):
+    UPSTREAM_EVENTS.labels(event).inc()
+
+
+def watch_store(store):
+    """Report the sessions (and, in memory, bytes) held by the conversation store
+
+    Each worker has its own MemoryStore, so those gauges are summed across
+    workers; a SqliteStore is shared, so every worker reports the same total.
+    """
+    global _store
+    mode = 'livesum' if isinstance(store, conversation_store.MemoryStore) else 'livemax'
+    _store_gauges['sessions'] = Gauge(
+        'chat_conversation_sessions', 'Sessions held by the conversation store',
+        multiprocess_mode=mode,
+    )
+    _store_gauges['turns'] = Gauge(
+        'chat_conversation_turns', 'Turns held by the conversation store',
+        multiprocess_mode=mode,
+    )
+    if mode == 'livesum':
+        _store_gauges['bytes'] = Gauge(
+            'chat_conversation_bytes', 'Text held by the in-memory conversation store',
+            multiprocess_mode=mode,
+        )
+    _store = store
+
+
+def _maybe_refresh_store(force=False):
+    global _store_refreshed
+    now = time.monotonic()
+    if _store is None or (not force and now - _store_refreshed < STORE_REFRESH_SECONDS):
+        return
+    # One refresh at a time; others skip rather than wait on the store
+    if not _store_lock.acquire(blocking=False):
+        return
+    try:
+        _store_refreshed = now
+        stats = _store.stats()
+        for name, gauge in _store_gauges.items():
+            gauge.set(stats.get(name, 0))
+    finally:
+        _store_lock.release()
+
+
+def render():
+    """Return the metrics page and its content type
+
+    Collecting from every worker's files is the expensive part, so a page is
+    reused for METRICS_CACHE_SECONDS.
+    """
+    global _page
+    with _page_lock:
+        rendered_at, body = _page
+        now = time.monotonic()
+        if not body or now - rendered_at >= METRICS_CACHE_SECONDS:
+            _maybe_refresh_store(force=True)
+            if MULTIPROC_DIR:
+                registry = CollectorRegistry()
+                multiprocess.MultiProcessCollector(registry)
+            else:
+                registry = REGISTRY
+            body = generate_latest(registry)
+            _page = (now, body)
+    return body, CONTENT_TYPE_LATEST
+
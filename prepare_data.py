@@ -0,0 +1,31 @@
+"""Build the retrieval index artifact from faq.txt and manual.txt
+
+Usage: python prepare_data.py [--out DIR]
+
+Workers memory-map the saved arrays at startup instead of re-parsing the
+knowledge files.
+"""
+import argparse
+import time
+
+import retrieval
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--out', default=retrieval.INDEX_DIR, help='index directory')
+    args = parser.parse_args()
+
+    started = time.time()
+    chunks = retrieval.load_chunks()
+    index = retrieval.RetrievalIndex.build(chunks, retrieval.source_digest())
+    index.save(args.out)
+
+    faq = sum(1 for c in chunks if c['source'] == 'faq')
+    print(f"✅ Indexed {faq} FAQ entries and {len(chunks) - faq} manual chunks")
+    print(f"   Vocabulary: {len(index.vocab)} terms, {len(index.doc_ids)} postings")
+    print(f"   Saved to {args.out} in {time.time() - started:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""Token-budgeted conversation windows for the model prompt
+
+Built ``types.Content`` objects are cached per session so each request only
+converts the turns added since the last one. Once the window exceeds
+HISTORY_TOKEN_BUDGET the oldest turns are folded into a running summary that
+is sent in their place, keeping prompt size flat in long sessions.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+from google.genai import types
+
+HISTORY_TOKEN_BUDGET = int(os.environ.get('HISTORY_TOKEN_BUDGET', '6000'))
+HISTORY_SUMMARY_TOKENS = int(os.environ.get('HISTORY_SUMMARY_TOKENS', '800'))
+# After folding, the window is cut back to this fraction of the budget so the
+# summary is refreshed every few turns rather than on every request
+HISTORY_FOLD_TARGET = float(os.environ.get('HISTORY_FOLD_TARGET', '0.6'))
+HISTORY_CACHE_SESSIONS = int(os.environ.get('HISTORY_CACHE_SESSIONS', '2048'))
+
+SUMMARY_PREFIX = "Summary of the earlier part of this conversation:\n"
+# Longest excerpt of a single turn kept in the summary
+SUMMARY_EXCERPT_CHARS = 200
+
+
+def estimate_tokens(text):
+    """Rough local token count (about four characters per token)"""
+    return len(text) // 4 + 4
+
+
+def content_text(content):
+    return ''.join(part.text or '' for part in content.parts)
+
+
+def summarize(previous, contents):
+    """Fold turns into the running summary by keeping a short excerpt of each"""
+    lines = previous.splitlines() if previous else []
+    for content in contents:
+        text = ' '.join(content_text(content).split())
+        first_sentence = text.split('. ')[0]
+        excerpt = first_sentence[:SUMMARY_EXCERPT_CHARS]
+        if len(excerpt) < len(text):
+            excerpt += '…'
+        speaker = 'User' if content.role == 'user' else 'Assistant'
+        lines.append(f"- {speaker}: {excerpt}")
+
+    # Keep the most recent lines that fit the summary budget
+    kept = []
+    tokens = 0
+    for line in reversed(lines):
+        tokens += estimate_tokens(line)
+        if tokens > HISTORY_SUMMARY_TOKENS:
+            break
+        kept.append(line)
+    return '\n'.join(reversed(kept))
+
+
+class _Window:
+    __slots__ = ('turns', 'last_text', 'contents', 'tokens', 'total', 'summary', 'summary_content')
+
+    def __init__(self):
+        self.turns = 0
+        self.last_text = None
+        self.contents = []
+        self.tokens = []
+        self.total = 0
+        self.summary = ''
+        self.summary_content = None
+
+
+class HistoryManager:
+    """Keeps each session's prompt window built, bounded and summarized
+
+    build converts a list of turns to Content objects (the server passes
+    build_conversation_contents); summarizer folds Content objects into the
+    running summary text.
+    """
+
+    def __init__(self, build, token_budget=HISTORY_TOKEN_BUDGET,
+                 max_sessions=HISTORY_CACHE_SESSIONS, summarizer=summarize):
+        self.build = build
+        self.token_budget = token_budget
+        self.max_sessions = max_sessions
+        self.summarizer = summarizer
+        self._windows = OrderedDict()
+        self._lock = threading.Lock()
+
+    def contents(self, session_id, history):
+        """Return the Contents to send for history (a list of turns, newest last)"""
+        with self._lock:
+            window = self._windows.get(session_id)
+            if window is None or not self._is_prefix(window, history):
+                window = _Window()
+            self._windows[session_id] = window
+            self._windows.move_to_end(session_id)
+            while len(self._windows) > self.max_sessions:
+                self._windows.popitem(last=False)
+
+            for turn in history[window.turns:]:
+                for content in self.build([turn]):
+                    tokens = estimate_tokens(content_text(content))
+                    window.contents.append(content)
+                    window.tokens.append(tokens)
+                    window.total += tokens
+            window.turns = len(history)
+            window.last_text = history[-1].content if history else None
+
+            if window.total > self.token_budget:
+                self._fold(window)
+
+            if window.summary_content is None:
+                return list(window.contents)
+            return [window.summary_content] + window.contents
+
+    def forget(self, session_id):
+        with self._lock:
+            self._windows.pop(session_id, None)
+
+    def _is_prefix(self, window, history):
+        # The cached window must describe the first window.turns turns of history;
+        # a cleared or expired session (possibly regrown elsewhere) fails this
+        if window.turns > len(history):
+            return False
+        return window.turns == 0 or history[window.turns - 1].content == window.last_text
+
+    def _fold(self, window):
+        target = self.token_budget * HISTORY_FOLD_TARGET
+        count = 0
+        # Never fold the newest turn, and resume the window on a user turn
+        while count < len(window.contents) - 1 and (
+            window.total > target or window.contents[count].role != 'user'
+        ):
+            window.total -= window.tokens[count]
+            count += 1
+        if not count:
+            return
+
+        folded = window.contents[:count]
+        del window.contents[:count]
+        del window.tokens[:count]
+
+        window.summary = self.summarizer(window.summary, folded)
+        window.summary_content = types.Content(
+            role="user",
+            parts=[types.Part.from_text(text=SUMMARY_PREFIX + window.summary)],
+        )
@@ -0,0 +1,504 @@
+"""Deadlines, retries, hedging and a circuit breaker around upstream streams
+
+``Upstream.stream`` (threads) and ``Upstream.stream_async`` (asyncio) wrap
+one generate_content_stream call:
+
+- Deadlines: every attempt must produce its first chunk within
+  UPSTREAM_FIRST_CHUNK_TIMEOUT, and the whole reply must finish within
+  UPSTREAM_TIMEOUT. Missing either raises UpstreamTimeout.
+- Retries: transient failures (5xx, 408/429, first-chunk timeouts, dropped
+  connections) are retried with full-jitter backoff, but only until the
+  first chunk arrives. After that the reply is already reaching the client.
+- Hedging: if an attempt has no chunk after the recent p95 time to first
+  chunk, a second attempt is started and whichever answers first is kept.
+  Hedges are capped at HEDGE_MAX_RATIO of calls so an upstream slowdown is
+  not doubled.
+- Circuit breaker: once most recent attempts have failed, calls fail fast
+  with CircuitOpen (an admission.Overloaded, so the servers answer 503)
+  until a probe after BREAKER_COOLDOWN succeeds.
+
+The state is per worker process.
+"""
+import asyncio
+import math
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+
+import httpx
+from google.genai import errors
+
+import admission
+import metrics
+
+UPSTREAM_TIMEOUT = float(os.environ.get('UPSTREAM_TIMEOUT', '120'))
+UPSTREAM_FIRST_CHUNK_TIMEOUT = float(os.environ.get('UPSTREAM_FIRST_CHUNK_TIMEOUT', '30'))
+UPSTREAM_RETRIES = int(os.environ.get('UPSTREAM_RETRIES', '2'))
+UPSTREAM_RETRY_BASE = float(os.environ.get('UPSTREAM_RETRY_BASE', '0.5'))
+UPSTREAM_RETRY_MAX = float(os.environ.get('UPSTREAM_RETRY_MAX', '4'))
+
+HEDGE_ENABLED = os.environ.get('HEDGE_ENABLED', '1') != '0'
+HEDGE_QUANTILE = float(os.environ.get('HEDGE_QUANTILE', '0.95'))
+# Never hedge sooner than this, however fast recent replies were
+HEDGE_MIN_DELAY = float(os.environ.get('HEDGE_MIN_DELAY', '1'))
+# Times to first chunk kept per model setup, and how many before hedging starts
+HEDGE_SAMPLES = int(os.environ.get('HEDGE_SAMPLES', '200'))
+HEDGE_MIN_SAMPLES = int(os.environ.get('HEDGE_MIN_SAMPLES', '20'))
+HEDGE_MAX_RATIO = float(os.environ.get('HEDGE_MAX_RATIO', '0.1'))
+
+BREAKER_ENABLED = os.environ.get('BREAKER_ENABLED', '1') != '0'
+# Open when at least BREAKER_THRESHOLD of the last BREAKER_WINDOW attempts failed
+BREAKER_WINDOW = int(os.environ.get('BREAKER_WINDOW', '20'))
+BREAKER_MIN_CALLS = int(os.environ.get('BREAKER_MIN_CALLS', '10'))
+BREAKER_THRESHOLD = float(os.environ.get('BREAKER_THRESHOLD', '0.5'))
+BREAKER_COOLDOWN = float(os.environ.get('BREAKER_COOLDOWN', '15'))
+
+# Unused hedge allowance carried over between calls
+HEDGE_BURST = 5
+_END = object()
+
+
+class UpstreamTimeout(Exception):
+    """An upstream deadline passed; stage is 'first_chunk' or 'total'"""
+
+    def __init__(self, stage, seconds):
+        super().__init__(f"No {'first chunk' if stage == 'first_chunk' else 'complete reply'} "
+                         f"from the model within {seconds:g}s")
+        self.stage = stage
+        self.seconds = seconds
+
+
+class CircuitOpen(admission.Overloaded):
+    """Raised instead of calling an upstream that is failing"""
+
+
+def is_transient(e):
+    """Failures that another attempt may not hit: overload, rate limit, 5xx, timeouts"""
+    if isinstance(e, errors.ServerError):
+        return True
+    if isinstance(e, errors.ClientError):
+        return e.code in (408, 429)
+    return isinstance(e, (UpstreamTimeout, asyncio.TimeoutError, httpx.TransportError))
+
+
+def describe_error(e):
+    """(HTTP status, metrics outcome, message, Retry-After or None) for a failed reply"""
+    if isinstance(e, admission.Overloaded):
+        return 503, 'overloaded', 'The assistant is busy right now. Please try again shortly.', e.retry_after
+    if isinstance(e, UpstreamTimeout):
+        return 504, 'timeout', 'The assistant took too long to answer. Please try again.', None
+    if is_transient(e):
+        return 503, 'unavailable', 'The assistant is unavailable right now. Please try again shortly.', 5
+    return 500, 'error', f'An error occurred: {str(e)}', None
+
+
+class CircuitBreaker:
+    """Closed, open after too many failures, then half-open for one probe"""
+
+    def __init__(self, enabled=BREAKER_ENABLED, window=BREAKER_WINDOW, min_calls=BREAKER_MIN_CALLS,
+                 threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.enabled = enabled
+        self.min_calls = min_calls
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._outcomes = deque(maxlen=window)
+        self._opened_at = None
+        self._probe_at = None
+        self._lock = threading.Lock()
+        self.trips = 0
+        self.rejected = 0
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return 'closed'
+        return 'open' if self._probe_at is None else 'half-open'
+
+    def check(self, probe=True):
+        """Raise CircuitOpen unless a call may go upstream now
+
+        With probe=False a call that would be the half-open probe passes
+        without claiming it, for checks made before the call itself.
+        """
+        if not self.enabled or self._opened_at is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if self._opened_at is None:
+                return
+            # One probe at a time; a probe that never reported back is replaced
+            if now >= self._opened_at + self.cooldown and (
+                    self._probe_at is None or now >= self._probe_at + self.cooldown):
+                if probe:
+                    self._probe_at = now
+                return
+            self.rejected += 1
+            retry_after = max(1, math.ceil(self._opened_at + self.cooldown - now))
+        raise CircuitOpen('upstream-unavailable', retry_after)
+
+    def allows_extra(self):
+        """Whether retries and hedges may be sent (only while closed)"""
+        return not self.enabled or self._opened_at is None
+
+    def record(self, ok):
+        if not self.enabled:
+            return
+        tripped = False
+        with self._lock:
+            if self._opened_at is not None:
+                if ok:
+                    self._opened_at = self._probe_at = None
+                    self._outcomes.clear()
+                    print("Circuit breaker closed: upstream is answering again")
+                else:
+                    self._opened_at, self._probe_at = time.monotonic(), None
+                return
+            self._outcomes.append(ok)
+            failures = self._outcomes.count(False)
+            if (len(self._outcomes) >= self.min_calls
+                    and failures >= self.threshold * len(self._outcomes)):
+                self._opened_at = time.monotonic()
+                self.trips += 1
+                tripped = True
+                print(f"Circuit breaker open: {failures} of the last {len(self._outcomes)} "
+                      f"upstream attempts failed")
+        if tripped:
+            metrics.record_upstream_event('circuit_open')
+
+    def stats(self):
+        with self._lock:
+            outcomes = list(self._outcomes)
+        return {
+            'enabled': self.enabled,
+            'state': self.state,
+            'recent_failures': outcomes.count(False),
+            'recent_attempts': len(outcomes),
+            'trips': self.trips,
+            'rejected': self.rejected,
+        }
+
+
+class _Attempt:
+    __slots__ = ('hedge', 'started', 'first_chunk_by', 'cancelled', 'stop', 'stream')
+
+    def __init__(self, hedge, started, first_chunk_by):
+        self.hedge = hedge
+        self.started = started
+        self.first_chunk_by = first_chunk_by
+        self.cancelled = False
+        # Set by the driver: stops the attempt's thread or task
+        self.stop = None
+        # The upstream stream, once the sync driver has opened it
+        self.stream = None
+
+
+class _Call:
+    """Decisions for one upstream call; the sync and async drivers do the waiting"""
+
+    def __init__(self, upstream, label):
+        self.upstream = upstream
+        self.label = label
+        self.deadline = time.monotonic() + upstream.timeout
+        self.live = []
+        self.winner = None
+        self.retries = 0
+        self.retry_at = None
+        self.hedge_at = None
+
+    def start(self, hedge=False):
+        now = time.monotonic()
+        attempt = _Attempt(hedge, now, min(self.deadline, now + self.upstream.first_chunk_timeout))
+        self.live.append(attempt)
+        if not hedge:
+            delay = self.upstream.hedge_delay(self.label)
+            self.hedge_at = now + delay if delay is not None else None
+        return attempt
+
+    def timeout(self):
+        """Seconds until the next deadline, retry or hedge"""
+        points = [self.deadline]
+        if self.winner is None:
+            points += [attempt.first_chunk_by for attempt in self.live]
+            points += [t for t in (self.retry_at, self.hedge_at) if t is not None]
+        return max(0.0, min(points) - time.monotonic())
+
+    def expire(self):
+        """Act on every deadline that has passed; returns attempts to launch"""
+        now = time.monotonic()
+        if now >= self.deadline:
+            self.cancel()
+            if self.winner is None:
+                self.upstream.breaker.record(False)
+                self.upstream.record_event('first_chunk_timeout')
+            self.upstream.record_event('timeout')
+            raise UpstreamTimeout('total', self.upstream.timeout)
+        if self.winner is not None:
+            return []
+
+        launch = []
+        for attempt in [a for a in self.live if now >= a.first_chunk_by]:
+            self.upstream.record_event('first_chunk_timeout')
+            launch += self.failed(attempt, UpstreamTimeout('first_chunk', self.upstream.first_chunk_timeout))
+        if self.retry_at is not None and now >= self.retry_at:
+            self.retry_at = None
+            launch.append(self.start())
+        if self.hedge_at is not None and now >= self.hedge_at:
+            self.hedge_at = None
+            if self.upstream.take_hedge():
+                launch.append(self.start(hedge=True))
+        return launch
+
+    def failed(self, attempt, error):
+        """attempt raised error; returns attempts to launch, or raises once out of options"""
+        self._drop(attempt)
+        if is_transient(error):
+            self.upstream.breaker.record(False)
+        if attempt is self.winner:
+            raise error
+        if self.live or self.retry_at is not None:
+            # Another attempt may still answer
+            return []
+
+        self.hedge_at = None
+        delay = random.uniform(0, min(self.upstream.retry_max,
+                                      self.upstream.retry_base * 2 ** self.retries))
+        if (not is_transient(error) or self.retries >= self.upstream.retries
+                or not self.upstream.breaker.allows_extra()
+                or time.monotonic() + delay >= self.deadline):
+            raise error
+        self.retries += 1
+        self.upstream.record_event('retry')
+        self.retry_at = time.monotonic() + delay
+        return []
+
+    def chunk(self, attempt):
+        """attempt produced a chunk: the first one makes it the winner"""
+        if self.winner is not None:
+            return
+        self.winner = attempt
+        self.retry_at = self.hedge_at = None
+        self.upstream.record_first_chunk(self.label, time.monotonic() - attempt.started)
+        self.upstream.breaker.record(True)
+        if attempt.hedge:
+            self.upstream.record_event('hedge_won')
+        for other in list(self.live):
+            if other is not attempt:
+                self._drop(other)
+
+    def cancel(self):
+        for attempt in list(self.live):
+            self._drop(attempt)
+
+    def _drop(self, attempt):
+        if attempt in self.live:
+            self.live.remove(attempt)
+        if not attempt.cancelled:
+            attempt.cancelled = True
+            if attempt is not self.winner and attempt.stop is not None:
+                attempt.stop()
+
+
+class Upstream:
+    """Policy and shared state (latency samples, hedge budget, breaker) for a process"""
+
+    def __init__(self, timeout=UPSTREAM_TIMEOUT, first_chunk_timeout=UPSTREAM_FIRST_CHUNK_TIMEOUT,
+                 retries=UPSTREAM_RETRIES, retry_base=UPSTREAM_RETRY_BASE,
+                 retry_max=UPSTREAM_RETRY_MAX, hedge=HEDGE_ENABLED, hedge_min_delay=HEDGE_MIN_DELAY,
+                 breaker=None):
+        self.timeout = timeout
+        self.first_chunk_timeout = first_chunk_timeout
+        self.retries = retries
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self.breaker = breaker or CircuitBreaker()
+        # label -> recent times to first chunk, and the hedge delay derived from them
+        self._samples = {}
+        self._delays = {}
+        self._hedge_tokens = 1.0
+        self._lock = threading.Lock()
+        self.events = {}
+
+    def check(self, probe=True):
+        """Fail fast with CircuitOpen while the upstream is down"""
+        self.breaker.check(probe)
+
+    def record_event(self, event):
+        with self._lock:
+            self.events[event] = self.events.get(event, 0) + 1
+        metrics.record_upstream_event(event)
+
+    def record_first_chunk(self, label, seconds):
+        with self._lock:
+            samples = self._samples.get(label)
+            if samples is None:
+                samples = self._samples[label] = deque(maxlen=HEDGE_SAMPLES)
+            samples.append(seconds)
+            # Re-sorting a few hundred floats every tenth sample is cheap enough
+            if len(samples) >= HEDGE_MIN_SAMPLES and len(samples) % 10 == 0:
+                ordered = sorted(samples)
+                index = min(len(ordered) - 1, int(HEDGE_QUANTILE * len(ordered)))
+                self._delays[label] = max(self.hedge_min_delay, ordered[index])
+
+    def hedge_delay(self, label):
+        """Seconds without a chunk before hedging, or None (disabled or too few samples)"""
+        if not self.hedge:
+            return None
+        with self._lock:
+            self._hedge_tokens = min(HEDGE_BURST, self._hedge_tokens + HEDGE_MAX_RATIO)
+        return self._delays.get(label)
+
+    def take_hedge(self):
+        if not self.breaker.allows_extra():
+            return False
+        with self._lock:
+            if self._hedge_tokens < 1:
+                return False
+            self._hedge_tokens -= 1
+        self.record_event('hedge')
+        return True
+
+    def stream(self, open_stream, label):
+        """Yield the chunks of open_stream(), a blocking iterator, within the policy
+
+        Each attempt runs in its own thread so a stalled one can be abandoned.
+        A dropped attempt's stream is closed at once when its thread is between
+        chunks, otherwise as soon as the next chunk arrives; a read that never
+        returns is ended by the client's HTTP timeout (gemini_client).
+        """
+        self.check()
+        call = _Call(self, label)
+        events = queue.Queue()
+
+        def launch(attempt):
+            attempt.stop = lambda: self._close_stream(attempt)
+            threading.Thread(target=self._pump, args=(attempt, open_stream, events), daemon=True).start()
+
+        launch(call.start())
+        try:
+            while True:
+                try:
+                    attempt, chunk, error = events.get(timeout=call.timeout())
+                except queue.Empty:
+                    for attempt in call.expire():
+                        launch(attempt)
+                    continue
+                if attempt.cancelled and attempt is not call.winner:
+                    continue
+                if error is not None:
+                    for attempt in call.failed(attempt, error):
+                        launch(attempt)
+                    continue
+                if chunk is _END:
+                    call.chunk(attempt)
+                    return
+                call.chunk(attempt)
+                yield chunk
+        finally:
+            call.cancel()
+            if call.winner is not None:
+                # The caller left mid-reply
+                call.winner.stop()
+
+    @staticmethod
+    def _close_stream(attempt):
+        stream = attempt.stream
+        if stream is None or not hasattr(stream, 'close'):
+            return
+        try:
+            stream.close()
+        except ValueError:
+            # Still reading in the pump thread, which closes it itself
+            pass
+
+    @staticmethod
+    def _pump(attempt, open_stream, events):
+        stream = None
+        try:
+            stream = attempt.stream = open_stream()
+            # Dropped while the request was being sent
+            if attempt.cancelled:
+                return
+            for chunk in stream:
+                if attempt.cancelled:
+                    return
+                events.put((attempt, chunk, None))
+            events.put((attempt, _END, None))
+        except Exception as e:
+            events.put((attempt, None, e))
+        finally:
+            if stream is not None and hasattr(stream, 'close'):
+                stream.close()
+
+    async def stream_async(self, open_stream, label):
+        """stream for the asyncio server: open_stream() is awaited for an async iterator"""
+        self.check()
+        call = _Call(self, label)
+        events = asyncio.Queue()
+
+        def launch(attempt):
+            task = asyncio.create_task(self._pump_async(attempt, open_stream, events))
+            attempt.stop = task.cancel
+
+        launch(call.start())
+        try:
+            while True:
+                try:
+                    attempt, chunk, error = await asyncio.wait_for(events.get(), call.timeout())
+                except asyncio.TimeoutError:
+                    for attempt in call.expire():
+                        launch(attempt)
+                    continue
+                if attempt.cancelled and attempt is not call.winner:
+                    continue
+                if error is not None:
+                    for attempt in call.failed(attempt, error):
+                        launch(attempt)
+                    continue
+                if chunk is _END:
+                    call.chunk(attempt)
+                    return
+                call.chunk(attempt)
+                yield chunk
+        finally:
+            call.cancel()
+            if call.winner is not None and call.winner.stop is not None:
+                # Closes the upstream stream when the caller leaves mid-reply
+                call.winner.stop()
+
+    @staticmethod
+    async def _pump_async(attempt, open_stream, events):
+        stream = None
+        try:
+            stream = await open_stream()
+            async for chunk in stream:
+                events.put_nowait((attempt, chunk, None))
+            events.put_nowait((attempt, _END, None))
+        except Exception as e:
+            events.put_nowait((attempt, None, e))
+        finally:
+            if stream is not None:
+                await stream.aclose()
+
+    def stats(self):
+        with self._lock:
+            delays = dict(self._delays)
+            samples = {label: len(s) for label, s in self._samples.items()}
+            events = dict(self.events)
+        return {
+            'timeout': self.timeout,
+            'first_chunk_timeout': self.first_chunk_timeout,
+            'retries': self.retries,
+            'hedge': self.hedge,
+            'hedge_delay': {label: round(delay, 3) for label, delay in delays.items()},
+            'samples': samples,
+            'events': events,
+            'breaker': self.breaker.stats(),
+        }
+
+
+upstream = Upstream()
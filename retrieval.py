@@ -0,0 +1,287 @@
+"""Local BM25 retrieval over faq.txt and manual.txt"""
+import hashlib
+import json
+import os
+import re
+import threading
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+FAQ_PATH = os.path.join(BASE_DIR, 'faq.txt')
+MANUAL_PATH = os.path.join(BASE_DIR, 'manual.txt')
+INDEX_DIR = os.environ.get('RETRIEVAL_INDEX_DIR', os.path.join(BASE_DIR, 'index'))
+
+# BM25 parameters
+K1 = 1.5
+B = 0.75
+
+# Manual sections longer than this are split on paragraph boundaries
+MANUAL_CHUNK_CHARS = 1500
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+HEADING_RE = re.compile(r"^(#{1,3})\s+(.*)$")
+QUESTION_RE = re.compile(r"^\**Q:\s*(.*?)\**$")
+ANSWER_RE = re.compile(r"^A:\s*(.*)$")
+
+STOPWORDS = frozenset("""
+a about after all also am an and any are as at be been before being but by can
+could did do does doing for from had has have having he her his how i if in
+into is it its just me more most my no not of on or other our out over own s
+same she should so some such t than that the their them then there these they
+this those through to too under until up very was we were what when where which
+while who whom why will with would you your yours
+""".split())
+
+
+def tokenize(text):
+    """Lowercase, drop stopwords and fold simple plurals"""
+    tokens = []
+    for token in TOKEN_RE.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        if len(token) > 4 and token.endswith('ies'):
+            token = token[:-3] + 'y'
+        elif len(token) > 3 and token.endswith('s') and not token.endswith('ss'):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+def parse_faq(path=FAQ_PATH):
+    """Return the Q/A pairs in faq.txt as dicts with question, answer and section"""
+    pairs = []
+    section = ''
+    question = None
+    answer = []
+
+    def flush():
+        if question and answer:
+            pairs.append({
+                'question': question,
+                'answer': ' '.join(answer),
+                'section': section,
+            })
+
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            heading = HEADING_RE.match(line)
+            q = QUESTION_RE.match(line)
+            a = ANSWER_RE.match(line)
+
+            if heading or q or line == '---':
+                flush()
+                question, answer = None, []
+                if heading:
+                    section = heading.group(2).strip()
+                elif q:
+                    question = q.group(1).strip()
+            elif a and question:
+                answer = [a.group(1).strip()]
+            elif line and answer:
+                answer.append(line)
+    flush()
+    return pairs
+
+
+def parse_manual(path=MANUAL_PATH):
+    """Split manual.txt into chunks along its ## and ### headings"""
+    chunks = []
+    titles = {}
+    lines = []
+
+    def flush():
+        text = '\n'.join(lines).strip()
+        if not text:
+            return
+        title = ' > '.join(titles[level] for level in sorted(titles) if level > 1)
+        for part in _split_paragraphs(text):
+            chunks.append({'title': title, 'text': part})
+
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            heading = HEADING_RE.match(line.rstrip())
+            if heading:
+                flush()
+                lines = []
+                level = len(heading.group(1))
+                titles = {lvl: t for lvl, t in titles.items() if lvl < level}
+                titles[level] = heading.group(2).strip()
+            else:
+                lines.append(line.rstrip())
+    flush()
+    return chunks
+
+
+def _split_paragraphs(text):
+    """Group paragraphs into parts of at most MANUAL_CHUNK_CHARS characters"""
+    parts = []
+    current = ''
+    for paragraph in re.split(r"\n\s*\n", text):
+        if current and len(current) + len(paragraph) > MANUAL_CHUNK_CHARS:
+            parts.append(current)
+            current = paragraph
+        else:
+            current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        parts.append(current)
+    return parts
+
+
+def load_chunks(faq_path=FAQ_PATH, manual_path=MANUAL_PATH):
+    """Collect retrievable chunks from both knowledge files"""
+    chunks = []
+    seen = set()
+    for pair in parse_faq(faq_path):
+        # faq.txt repeats some entries verbatim; index each one once
+        key = (pair['question'], pair['answer'])
+        if key in seen:
+            continue
+        seen.add(key)
+        chunks.append({
+            'source': 'faq',
+            'title': pair['question'],
+            'text': f"Q: {pair['question']}\nA: {pair['answer']}",
+        })
+    for chunk in parse_manual(manual_path):
+        chunks.append({
+            'source': 'manual',
+            'title': chunk['title'],
+            'text': chunk['text'],
+        })
+    return chunks
+
+
+def source_digest(faq_path=FAQ_PATH, manual_path=MANUAL_PATH):
+    """Hash of the knowledge files, used to spot a stale index"""
+    digest = hashlib.sha256()
+    for path in (faq_path, manual_path):
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+class RetrievalIndex:
+    """BM25 index stored as per-term postings with precomputed weights
+
+    Postings are laid out CSR-style: the documents containing term ``t`` are
+    ``doc_ids[term_ptr[t]:term_ptr[t + 1]]`` with matching BM25 ``weights``,
+    so scoring a query is a single ``np.bincount`` over the gathered postings.
+    """
+
+    ARRAYS = ('term_ptr', 'doc_ids', 'weights')
+
+    def __init__(self, chunks, vocab, term_ptr, doc_ids, weights, digest=None):
+        self.chunks = chunks
+        self.vocab = vocab
+        self.term_ptr = term_ptr
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.digest = digest
+
+    @classmethod
+    def build(cls, chunks, digest=None):
+        doc_tokens = [tokenize(f"{c['title']}\n{c['text']}") for c in chunks]
+        doc_len = np.array([len(t) for t in doc_tokens], dtype=np.float32)
+        avg_len = float(doc_len.mean()) if len(doc_len) else 0.0
+
+        vocab = {}
+        postings = []
+        for doc_id, tokens in enumerate(doc_tokens):
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, tf in counts.items():
+                term_id = vocab.setdefault(token, len(vocab))
+                postings.append((term_id, doc_id, tf))
+
+        postings.sort()
+        terms = np.array([p[0] for p in postings], dtype=np.int64)
+        doc_ids = np.array([p[1] for p in postings], dtype=np.int32)
+        tf = np.array([p[2] for p in postings], dtype=np.float32)
+
+        df = np.bincount(terms, minlength=len(vocab)).astype(np.float32)
+        idf = np.log1p((len(chunks) - df + 0.5) / (df + 0.5))
+        norm = K1 * (1 - B + B * doc_len[doc_ids] / max(avg_len, 1.0))
+        weights = (idf[terms] * tf * (K1 + 1) / (tf + norm)).astype(np.float32)
+
+        term_ptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(df.astype(np.int64), out=term_ptr[1:])
+
+        return cls(chunks, vocab, term_ptr, doc_ids, weights, digest)
+
+    def save(self, directory=INDEX_DIR):
+        os.makedirs(directory, exist_ok=True)
+        for name in self.ARRAYS:
+            np.save(os.path.join(directory, f'{name}.npy'), getattr(self, name))
+        with open(os.path.join(directory, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump({
+                'digest': self.digest,
+                'vocab': self.vocab,
+                'chunks': self.chunks,
+            }, f)
+
+    @classmethod
+    def load(cls, directory=INDEX_DIR):
+        """Load a saved index; the arrays are memory-mapped, not copied"""
+        with open(os.path.join(directory, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+        arrays = {
+            name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')
+            for name in cls.ARRAYS
+        }
+        return cls(meta['chunks'], meta['vocab'], digest=meta['digest'], **arrays)
+
+    def search(self, query, top_k=3):
+        """Return up to top_k (score, chunk) pairs, best first"""
+        term_ids = {self.vocab[t] for t in tokenize(query) if t in self.vocab}
+        if not term_ids:
+            return []
+
+        spans = [
+            (self.term_ptr[t], self.term_ptr[t + 1]) for t in term_ids
+        ]
+        docs = np.concatenate([self.doc_ids[s:e] for s, e in spans])
+        weights = np.concatenate([self.weights[s:e] for s, e in spans])
+        scores = np.bincount(docs, weights=weights, minlength=len(self.chunks))
+
+        top_k = min(top_k, len(self.chunks))
+        best = np.argpartition(scores, -top_k)[-top_k:]
+        best = best[np.argsort(scores[best])[::-1]]
+        return [
+            (float(scores[i]), self.chunks[i]) for i in best if scores[i] > 0
+        ]
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """Return the process-wide index, loading the prebuilt artifact when it is current"""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = _load_or_build()
+    return _index
+
+
+def _load_or_build():
+    digest = source_digest()
+    if os.path.exists(os.path.join(INDEX_DIR, 'meta.json')):
+        index = RetrievalIndex.load(INDEX_DIR)
+        if index.digest == digest:
+            return index
+        print("Retrieval index is out of date, rebuilding in memory (run prepare_data.py)")
+    return RetrievalIndex.build(load_chunks(), digest)
+
+
+def format_context(results):
+    """Render search results as a reference block for the prompt"""
+    sections = []
+    for _, chunk in results:
+        label = 'FAQ' if chunk['source'] == 'faq' else f"Manual - {chunk['title']}"
+        sections.append(f"[{label}]\n{chunk['text']}")
+    return "\n\n".join(sections)
@@ -0,0 +1,174 @@
+"""Model routing: send each question to the cheapest tier that can answer it
+
+Tiers differ in model, thinking budget and whether the web search tool is
+attached:
+
+- lite: short how-to questions the knowledge base answers directly
+- standard: grounded questions that need reasoning, and follow-ups
+- full: anything outside the knowledge base or about current events
+
+Routing is local and cheap: the BM25 score of the best knowledge-base match,
+the share of the message's terms that appear in the FAQ and manual
+vocabulary, its length, and a few keyword lists. Every tier setting and
+threshold can be overridden with ROUTE_* environment variables; set
+ROUTING_FORCE_TIER to send everything to one tier (for comparisons) or
+ROUTING_ENABLED=0 to route only on grounding, as before.
+"""
+import os
+import re
+import threading
+
+import gemini_client
+import retrieval
+
+ROUTING_ENABLED = os.environ.get('ROUTING_ENABLED', '1') != '0'
+ROUTING_FORCE_TIER = os.environ.get('ROUTING_FORCE_TIER', '')
+# Print one line per decision
+ROUTING_LOG = os.environ.get('ROUTING_LOG', '1') != '0'
+
+# Grounded questions at most this long, matching this well, go to the lite tier
+ROUTE_LITE_MAX_WORDS = int(os.environ.get('ROUTE_LITE_MAX_WORDS', '20'))
+ROUTE_LITE_MIN_SCORE = float(os.environ.get('ROUTE_LITE_MIN_SCORE', '8'))
+ROUTE_LITE_MIN_COVERAGE = float(os.environ.get('ROUTE_LITE_MIN_COVERAGE', '0.75'))
+# Grounded messages this short without a question mark (terse lookups of a
+# knowledge-base topic) need no reasoning
+ROUTE_SMALL_TALK_WORDS = int(os.environ.get('ROUTE_SMALL_TALK_WORDS', '3'))
+# Ungrounded follow-ups that still mostly use knowledge-base terms stay off search
+ROUTE_FOLLOW_UP_MIN_COVERAGE = float(os.environ.get('ROUTE_FOLLOW_UP_MIN_COVERAGE', '0.5'))
+
+
+def _terms(name, default):
+    return tuple(t.strip() for t in os.environ.get(name, default).split(',') if t.strip())
+
+
+# Phrases that need reasoning beyond restating a procedure
+ROUTE_COMPLEX_TERMS = _terms(
+    'ROUTE_COMPLEX_TERMS',
+    'why,explain,compare,difference,versus,vs,troubleshoot,error,fail,not working,'
+    'issue,problem,recommend,should i,best,pros,cons,what if',
+)
+# Phrases that need information newer than the knowledge base; everyday words
+# like "now" or "current" ("my current password") are deliberately absent
+ROUTE_FRESH_TERMS = _terms(
+    'ROUTE_FRESH_TERMS',
+    'latest,news,recent,recently,this year,this month,regulation,regulations',
+)
+
+TIER_DEFAULTS = {
+    'lite': {'model': 'gemini-flash-lite-latest', 'thinking': 0, 'search': False},
+    'standard': {'model': gemini_client.MODEL, 'thinking': -1, 'search': False},
+    'full': {'model': gemini_client.MODEL, 'thinking': -1, 'search': True},
+}
+
+_COMPLEX_RE = re.compile(r"\b(?:%s)\b" % '|'.join(map(re.escape, ROUTE_COMPLEX_TERMS)))
+# A year in the question also asks for current information
+_FRESH_RE = re.compile(r"\b(?:%s|20\d\d)\b" % '|'.join(map(re.escape, ROUTE_FRESH_TERMS)))
+
+
+class Tier:
+    """One model setup; config is the GenerateContentConfig built for it"""
+
+    __slots__ = ('name', 'model', 'thinking_budget', 'search', 'config')
+
+    def __init__(self, name, model, thinking_budget, search):
+        self.name = name
+        self.model = model
+        self.thinking_budget = thinking_budget
+        self.search = search
+        self.config = None
+
+    @classmethod
+    def from_env(cls, name, defaults):
+        prefix = f'ROUTE_{name.upper()}_'
+        return cls(
+            name,
+            os.environ.get(prefix + 'MODEL', defaults['model']),
+            int(os.environ.get(prefix + 'THINKING', defaults['thinking'])),
+            os.environ.get(prefix + 'SEARCH', '1' if defaults['search'] else '0') == '1',
+        )
+
+
+class Route:
+    __slots__ = ('tier', 'reason')
+
+    def __init__(self, tier, reason):
+        self.tier = tier
+        self.reason = reason
+
+
+class Router:
+    """Pick a tier per request; build_config(tier) makes each tier's config once"""
+
+    def __init__(self, build_config, enabled=ROUTING_ENABLED, force_tier=ROUTING_FORCE_TIER):
+        self.tiers = {name: Tier.from_env(name, defaults) for name, defaults in TIER_DEFAULTS.items()}
+        for tier in self.tiers.values():
+            tier.config = build_config(tier)
+        if force_tier and force_tier not in self.tiers:
+            raise ValueError(f"Unknown ROUTING_FORCE_TIER: {force_tier}")
+        self.enabled = enabled
+        self.force_tier = force_tier
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def route(self, message, history, score, grounded):
+        """Return the Route for message
+
+        score is the best knowledge-base match and grounded whether that
+        match was attached to the prompt.
+        """
+        if self.force_tier:
+            name, reason = self.force_tier, 'forced'
+        elif not self.enabled:
+            name, reason = ('standard', 'grounded') if grounded else ('full', 'ungrounded')
+        else:
+            name, reason = self._classify(message, history, score, grounded)
+
+        route = Route(self.tiers[name], reason)
+        with self._lock:
+            key = (name, reason)
+            self._counts[key] = self._counts.get(key, 0) + 1
+        if ROUTING_LOG:
+            print(f"Route: {name} ({reason}) score={score:.1f} words={len(message.split())}")
+        return route
+
+    def _classify(self, message, history, score, grounded):
+        text = message.lower()
+        words = len(text.split())
+
+        if _FRESH_RE.search(text):
+            return 'full', 'fresh-information'
+
+        terms = retrieval.tokenize(message)
+        vocab = retrieval.get_index().vocab
+        coverage = sum(1 for t in terms if t in vocab) / len(terms) if terms else 0.0
+
+        if not grounded:
+            if history and coverage >= ROUTE_FOLLOW_UP_MIN_COVERAGE:
+                return 'standard', 'follow-up'
+            return 'full', 'outside-knowledge-base'
+
+        if _COMPLEX_RE.search(text) or words > ROUTE_LITE_MAX_WORDS or text.count('?') > 1:
+            return 'standard', 'complex'
+        # Only once grounded: a terse message the index can't answer needs search
+        if words <= ROUTE_SMALL_TALK_WORDS and '?' not in text:
+            return 'lite', 'short-message'
+        if score >= ROUTE_LITE_MIN_SCORE and coverage >= ROUTE_LITE_MIN_COVERAGE:
+            return 'lite', 'knowledge-base-lookup'
+        return 'standard', 'grounded'
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._counts)
+        return {
+            'enabled': self.enabled,
+            'force_tier': self.force_tier or None,
+            'tiers': {
+                tier.name: {
+                    'model': tier.model,
+                    'thinking_budget': tier.thinking_budget,
+                    'search': tier.search,
+                }
+                for tier in self.tiers.values()
+            },
+            'decisions': {f'{name}/{reason}': n for (name, reason), n in sorted(counts.items())},
+        }
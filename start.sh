@@ -37,6 +37,11 @@ pip install -r requirements.txt --quiet
 echo "✅ Packages installed!"
 echo ""
 
+# Build the knowledge-base index from faq.txt and manual.txt
+echo "📚 Building knowledge index..."
+python prepare_data.py
+echo ""
+
 # Get local IP address
 IP_ADDRESS=$(hostname -I | awk '{print $1}')
 
@@ -52,5 +57,5 @@ echo "Press Ctrl+C to stop the server"
 echo "=========================================="
 echo ""
 
-# Run the server
-python chatbot_server.py
+# Run the server (async, see asgi_server.py)
+python asgi_server.py